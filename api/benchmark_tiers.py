@@ -0,0 +1,117 @@
+"""
+This script benchmarks the speed tiers of the Ausonia API against each other. For every tier it runs a
+fixed set of prompts through a model's pipeline with fixed seeds, and reports:
+- The average time taken per image
+- The PSNR and SSIM of each tier's images against the "quality" tier's images of the same prompt
+
+Run it from the api directory, on the machine the API will run on, so the numbers reflect the real
+hardware. The resulting table can then be used to pick each model's tier settings in config.json.
+
+Usage: python3 benchmark_tiers.py --model MODEL_ID [--steps 30] [--width 512] [--height 512] [--device cuda:0]
+"""
+
+import argparse
+import time
+import numpy as np
+import torch
+from modules import general
+from modules.pipeline_cache import CachedPipeline
+from modules.embedding_cache import EmbeddingCache
+from modules.pipeline_loader import load_pipeline
+from modules.speed_tiers import SPEED_TIERS, apply_speed_tier, get_speed_tier
+
+PROMPTS = [
+    "a photograph of a lighthouse on a cliff at sunset, dramatic clouds",
+    "portrait of an old fisherman, detailed wrinkles, soft window light",
+    "a bowl of ramen on a wooden table, steam rising, shallow depth of field",
+    "a futuristic city street at night, neon signs, rain reflections",
+    "a watercolor painting of a fox in a snowy forest"
+]
+SEED = 1234
+
+def to_grayscale(image) -> np.ndarray:
+    return np.asarray(image.convert("L"), dtype=np.float64)
+
+def psnr(reference: np.ndarray, candidate: np.ndarray) -> float:
+    mse = np.mean((reference - candidate) ** 2)
+    if mse == 0:
+        return float("inf")
+    return 20 * np.log10(255.0) - 10 * np.log10(mse)
+
+def ssim(reference: np.ndarray, candidate: np.ndarray, block: int = 8) -> float:
+    # SSIM averaged over non-overlapping blocks, which is close enough to the
+    # windowed version for comparing tiers and needs nothing beyond numpy.
+    height = reference.shape[0] - reference.shape[0] % block
+    width = reference.shape[1] - reference.shape[1] % block
+    shape = (height // block, block, width // block, block)
+    ref_blocks = reference[:height, :width].reshape(shape).transpose(0, 2, 1, 3).reshape(-1, block * block)
+    can_blocks = candidate[:height, :width].reshape(shape).transpose(0, 2, 1, 3).reshape(-1, block * block)
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    ref_mean = ref_blocks.mean(axis=1)
+    can_mean = can_blocks.mean(axis=1)
+    ref_var = ref_blocks.var(axis=1)
+    can_var = can_blocks.var(axis=1)
+    covariance = ((ref_blocks - ref_mean[:, None]) * (can_blocks - can_mean[:, None])).mean(axis=1)
+    scores = ((2 * ref_mean * can_mean + c1) * (2 * covariance + c2)) / (
+        (ref_mean ** 2 + can_mean ** 2 + c1) * (ref_var + can_var + c2)
+    )
+    return float(scores.mean())
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API's speed tiers.")
+    parser.add_argument("--model", required=True, help="The ID of the model in config.json.")
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--cfg-scale", type=float, default=7.5)
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model = next((entry for entry in general.get_config() if entry["id"] == args.model), None)
+    if model is None:
+        raise ValueError(f"Model '{args.model}' is not in config.json")
+    torch_dtype = torch.float16 if args.device.startswith("cuda") else torch.float32
+    pipe, helper = load_pipeline(model, args.device, torch_dtype)
+    entry = CachedPipeline(model["id"], pipe, helper, 0, EmbeddingCache(0))
+    negative_prompt = general.get_negative_prompt()
+
+    # Warm up once so the first tier doesn't pay for kernel selection.
+    apply_speed_tier(entry, get_speed_tier(model, "quality"))
+    pipe(PROMPTS[0], negative_prompt=negative_prompt, width=args.width, height=args.height, num_inference_steps=2)
+
+    images = {}
+    timings = {}
+    for tier_name in ("quality",) + tuple(name for name in SPEED_TIERS if name != "quality"):
+        tier = get_speed_tier(model, tier_name)
+        apply_speed_tier(entry, tier)
+        steps = min(args.steps, tier["max_steps"])
+        images[tier_name] = []
+        start_time = time.perf_counter()
+        for prompt in PROMPTS:
+            images[tier_name].append(pipe(
+                prompt,
+                negative_prompt=negative_prompt,
+                width=args.width,
+                height=args.height,
+                num_inference_steps=steps,
+                guidance_scale=args.cfg_scale,
+                generator=torch.Generator(device="cpu").manual_seed(SEED)
+            ).images[0])
+        timings[tier_name] = (time.perf_counter() - start_time) / len(PROMPTS)
+
+    print(f"Model: {model['id']} | {args.width}x{args.height} | {args.steps} steps requested | {args.device}")
+    print(f"{'Tier':<10} {'Steps':>5} {'s/image':>9} {'Speedup':>8} {'PSNR':>7} {'SSIM':>6}")
+    for tier_name in SPEED_TIERS:
+        tier = get_speed_tier(model, tier_name)
+        references = [to_grayscale(image) for image in images["quality"]]
+        candidates = [to_grayscale(image) for image in images[tier_name]]
+        mean_psnr = np.mean([psnr(ref, can) for ref, can in zip(references, candidates)])
+        mean_ssim = np.mean([ssim(ref, can) for ref, can in zip(references, candidates)])
+        print(
+            f"{tier_name:<10} {min(args.steps, tier['max_steps']):>5} {timings[tier_name]:>9.2f} "
+            f"{timings['quality'] / timings[tier_name]:>7.2f}x {mean_psnr:>7.2f} {mean_ssim:>6.3f}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
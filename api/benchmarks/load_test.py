@@ -0,0 +1,243 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+"""
+Load tests the inference API with a stub pipeline, so changes to scheduling,
+batching or caching in the job processor can be checked for throughput and
+latency regressions on a plain CPU machine.
+
+The API is started in-process on a random local port with stub pipelines in
+place of real checkpoints, then requests are sent at a Poisson arrival rate
+from a weighted mix and followed through /get_result until they finish.
+
+Usage, from the api directory:
+    python3 -m benchmarks.load_test --rate 4 --duration 60 --step-time 0.02 --devices cpu:1,cpu:1
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional
+import httpx
+import psutil
+import uvicorn
+
+DEFAULT_MIX = [
+    {
+        "weight": 0.7,
+        "request": {"model": "stub-sd", "width": 512, "height": 512, "steps": 20, "cfg_scale": 7.5}
+    },
+    {
+        "weight": 0.2,
+        "request": {"model": "stub-sd", "width": 768, "height": 768, "steps": 30, "cfg_scale": 7.5}
+    },
+    {
+        "weight": 0.1,
+        "request": {"model": "stub-xl", "width": 1024, "height": 1024, "steps": 30, "cfg_scale": 4.0}
+    }
+]
+STUB_MEMORY_BYTES = 1024 ** 2
+PROMPTS = [
+    "a lighthouse on a cliff at sunset",
+    "portrait of an old fisherman",
+    "a bowl of ramen on a wooden table",
+    "a futuristic city street at night"
+]
+
+class JobTiming:
+    def __init__(self, submitted_at: float):
+        self.submitted_at = submitted_at
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.status: Optional[str] = None
+
+def percentile(values: list[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def prepare_workdir(workdir: str):
+    """
+    Writes the config.json and negative_prompt.txt the API reads at import
+    time, describing the stub models used by the default mix. Stub pipelines
+    hold no weights, so their memory estimates are kept small enough for the
+    mix to be admitted on any machine.
+    """
+    config = [
+        {"id": "stub-sd", "name": "Stub SD", "pipeline": "StableDiffusionPipeline",
+         "path": "./models/stub-sd.safetensors", "is_nsfw": False, "memory_bytes": STUB_MEMORY_BYTES},
+        {"id": "stub-xl", "name": "Stub XL", "pipeline": "StableDiffusionXLPipeline",
+         "path": "./models/stub-xl.safetensors", "is_nsfw": False, "memory_bytes": STUB_MEMORY_BYTES}
+    ]
+    with open(os.path.join(workdir, "config.json"), "w", encoding="UTF-8") as f:
+        json.dump(config, f, indent=4)
+    with open(os.path.join(workdir, "negative_prompt.txt"), "w", encoding="UTF-8") as f:
+        f.write("blurry\nlow quality\n")
+
+def start_api(args: argparse.Namespace, port: int) -> uvicorn.Server:
+    """
+    Imports the API with its pipeline loader and tokenizer replaced by stubs,
+    and serves it from a background thread.
+    """
+    # pylint: disable=C0415
+    from benchmarks import stub_pipeline
+    from modules import job_processing, validation
+    job_processing.load_pipeline = stub_pipeline.make_stub_loader(
+        args.step_time,
+        args.batch_cost,
+        tuple(int(value) for value in args.output_size.split("x")) if args.output_size else None
+    )
+    validation.CLIPTokenizer = stub_pipeline.StubTokenizer
+    import server
+    config = uvicorn.Config(server.APP, host="127.0.0.1", port=port, log_level="warning")
+    api_server = uvicorn.Server(config)
+    thread = threading.Thread(target=api_server.run, daemon=True)
+    thread.start()
+    while not api_server.started:
+        time.sleep(0.05)
+    return api_server
+
+def sample_rss(stop_event: threading.Event, peak: list[int]):
+    process = psutil.Process()
+    while not stop_event.is_set():
+        peak[0] = max(peak[0], process.memory_info().rss)
+        time.sleep(0.1)
+
+async def follow_job(client: httpx.AsyncClient, request: dict, poll_interval: float, timings: list[JobTiming]):
+    timing = JobTiming(time.perf_counter())
+    timings.append(timing)
+    response = await client.post("/inference", json=request)
+    if response.status_code != 200:
+        timing.status = f"HTTP {response.status_code}"
+        timing.finished_at = time.perf_counter()
+        return
+    job_id = response.json()["job_id"]
+    while True:
+        result = (await client.get(f"/get_result/{job_id}", params={"include_image": "false"})).json()
+        status = result.get("status")
+        now = time.perf_counter()
+        if status != "PENDING" and timing.started_at is None:
+            timing.started_at = now
+        if status in ("COMPLETED", "FAILED") or status is None:
+            timing.status = status or "MISSING"
+            timing.finished_at = now
+            return
+        await asyncio.sleep(poll_interval)
+
+async def generate_load(args: argparse.Namespace, base_url: str, mix: list[dict]) -> tuple[list[JobTiming], float]:
+    """
+    Sends requests with exponentially distributed gaps for the configured
+    duration, then waits for every job to finish.
+
+    Returns:
+        The timing of every job and the wall time from the first request to
+        the last job finishing.
+    """
+    rng = random.Random(args.random_seed)
+    weights = [entry["weight"] for entry in mix]
+    timings = []
+    tasks = []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+        start_time = time.perf_counter()
+        while time.perf_counter() - start_time < args.duration:
+            request = dict(rng.choices(mix, weights)[0]["request"])
+            request.setdefault("prompt", rng.choice(PROMPTS))
+            request.setdefault("negative_prompt", "")
+            request.setdefault("user_id", rng.randrange(args.users))
+            request.setdefault("guild_id", 0)
+            tasks.append(asyncio.create_task(follow_job(client, request, args.poll_interval, timings)))
+            await asyncio.sleep(rng.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+        return timings, time.perf_counter() - start_time
+
+def build_report(timings: list[JobTiming], wall_time: float, peak_rss: int) -> dict:
+    completed = [timing for timing in timings if timing.status == "COMPLETED"]
+    queue_times = [timing.started_at - timing.submitted_at for timing in completed if timing.started_at is not None]
+    end_to_end = [timing.finished_at - timing.submitted_at for timing in completed]
+    report = {
+        "submitted": len(timings),
+        "completed": len(completed),
+        "failed": len(timings) - len(completed),
+        "wall_time_seconds": round(wall_time, 3),
+        "throughput_jobs_per_second": round(len(completed) / wall_time, 3) if wall_time > 0 else 0,
+        "peak_rss_mb": round(peak_rss / 1024 ** 2, 1)
+    }
+    for name, values in (("queue_time", queue_times), ("end_to_end", end_to_end)):
+        for label, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            value = percentile(values, fraction)
+            report[f"{name}_{label}_seconds"] = round(value, 3) if value is not None else None
+        report[f"{name}_mean_seconds"] = round(statistics.fmean(values), 3) if values else None
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the inference API with a stub pipeline.")
+    parser.add_argument("--rate", type=float, default=2.0, help="Average requests per second.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to keep sending requests for.")
+    parser.add_argument("--mix", help="A JSON file of weighted requests, in the same shape as DEFAULT_MIX.")
+    parser.add_argument("--users", type=int, default=8, help="The number of distinct submitters.")
+    parser.add_argument("--step-time", type=float, default=0.02, help="Seconds per denoising step.")
+    parser.add_argument("--batch-cost", type=float, default=0.5,
+                        help="Extra step cost of each additional image in a batch.")
+    parser.add_argument("--output-size", help="Override the generated image size, e.g. 512x512.")
+    parser.add_argument("--devices", default="cpu:1", help="The INFERENCE_DEVICES to run the API with.")
+    parser.add_argument("--poll-interval", type=float, default=0.02)
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the report to this file as well.")
+    args = parser.parse_args()
+
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    mix = DEFAULT_MIX
+    if args.mix:
+        with open(args.mix, "r", encoding="UTF-8") as f:
+            mix = json.load(f)
+
+    api_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, api_dir)
+    workdir = tempfile.mkdtemp(prefix="ausonia_load_test_")
+    prepare_workdir(workdir)
+    os.chdir(workdir)
+    os.environ["INFERENCE_DEVICES"] = args.devices
+    # Jobs turned away by admission control would be counted as failures, and
+    # the estimates it works from assume real pipelines, so it is off unless
+    # explicitly configured.
+    os.environ.setdefault("ADMISSION_MAX_QUEUED_SECONDS", "0")
+    os.environ.setdefault("ADMISSION_MEMORY_HEADROOM", "inf")
+    os.environ.setdefault("RESULTS_DIR", os.path.join(workdir, "results"))
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    api_server = start_api(args, port)
+
+    stop_event = threading.Event()
+    peak_rss = [0]
+    sampler = threading.Thread(target=sample_rss, args=(stop_event, peak_rss), daemon=True)
+    sampler.start()
+    try:
+        timings, wall_time = asyncio.run(generate_load(args, f"http://127.0.0.1:{port}", mix))
+    finally:
+        stop_event.set()
+        api_server.should_exit = True
+
+    report = build_report(timings, wall_time, peak_rss[0])
+    for key, value in report.items():
+        print(f"{key:<32} {value}")
+    if args.json:
+        with open(args.json, "w", encoding="UTF-8") as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+"""
+Stand-ins for the diffusers pipeline, DeepCache helper and CLIP tokenizer, so
+the job processor can be load tested on a machine without a GPU or any model
+checkpoints. Only the parts of each interface the API actually uses exist.
+"""
+
+import time
+from types import SimpleNamespace
+from typing import Optional
+import diffusers
+import numpy as np
+import torch
+from PIL import Image
+
+class StubTokenizer:
+    @classmethod
+    def from_pretrained(cls, *_args, **_kwargs) -> "StubTokenizer":
+        return cls()
+
+    def __call__(self, text: str) -> dict:
+        # One token per word, plus the start and end tokens CLIP adds.
+        return {"input_ids": [0] * (len(text.split()) + 2)}
+
+class StubHelper:
+    def __init__(self, pipe=None):
+        self.pipe = pipe
+        self.params = {}
+
+    def set_params(self, **params):
+        self.params = params
+
+    def enable(self):
+        pass
+
+    def disable(self):
+        pass
+
+class StubPipeline:
+    def __init__(self, step_time: float, batch_cost: float, output_size: Optional[tuple[int, int]] = None):
+        self.step_time = step_time
+        self.batch_cost = batch_cost
+        self.output_size = output_size
+        self.scheduler = diffusers.DDIMScheduler()
+        self.components = {}
+        self.config = {}
+        self._execution_device = "cpu"
+        self._rng = np.random.default_rng()
+
+    def encode_prompt(self, prompt: str, **_kwargs) -> tuple:
+        return torch.zeros(1, 77, 768), None
+
+    def __call__(self, prompt_embeds: torch.Tensor, width: int, height: int, num_inference_steps: int,
+                 num_images_per_prompt: int = 1, callback_on_step_end=None, **_kwargs) -> SimpleNamespace:
+        """
+        Sleeps for each denoising step instead of running a UNet. A batch of
+        n images costs (1 + (n - 1) * batch_cost) times a single image, to
+        model how batching amortises each step on real hardware.
+        """
+        batch_size = prompt_embeds.shape[0] * num_images_per_prompt
+        latents = torch.zeros(batch_size, 4, height // 8, width // 8)
+        step_time = self.step_time * (1 + (batch_size - 1) * self.batch_cost)
+        for step in range(num_inference_steps):
+            time.sleep(step_time)
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, step, {"latents": latents})
+        output_width, output_height = self.output_size or (width, height)
+        images = []
+        for _ in range(batch_size):
+            pixels = self._rng.integers(0, 256, (output_height, output_width, 3), dtype=np.uint8)
+            images.append(Image.fromarray(pixels))
+        return SimpleNamespace(images=images)
+
+def make_stub_loader(step_time: float, batch_cost: float, output_size: Optional[tuple[int, int]] = None):
+    """
+    Builds a replacement for modules.pipeline_loader.load_pipeline that
+    returns stub pipelines instead of loading checkpoints.
+
+    Args:
+        step_time: Seconds each denoising step sleeps for a single image.
+        batch_cost: The extra cost of each additional image in a batch, as a
+            fraction of a single image's step time.
+        output_size: An optional (width, height) for the generated images,
+            overriding the requested size.
+
+    Returns:
+        A callable with the same signature as load_pipeline.
+    """
+    def load_stub_pipeline(_model: dict, _device: str, _torch_dtype, _auth_token=None, _cache_dir=None) -> tuple:
+        pipe = StubPipeline(step_time, batch_cost, output_size)
+        return pipe, StubHelper(pipe)
+    return load_stub_pipeline
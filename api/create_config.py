@@ -3,35 +3,77 @@ This script automatically generates a configuration file (config.json) for the A
 the models directory for .safetensors files. For each model found, it creates a configuration entry
 containing:
 - name: The model name (derived from the filename)
-- pipeline: The model's pipeline type
-- path: The absolute path to the model file
+- pipeline: The model's diffusers pipeline class, detected from the checkpoint
+- path: The path to the model file
 - is_nsfw: A flag indicating whether the model generates NSFW content (default: False)
+- architecture: The detected architecture, one of sd1, sd2, sdxl or sdxl-refiner. Refiner and inpainting
+  checkpoints can't be used for text-to-image generation, so their pipeline is not filled in
+- parameters: The number of parameters in the checkpoint
+- memory_bytes: The estimated size of the weights in fp16, used by the API for admission control
+- sha256: The hash of the checkpoint file
+
+Only the JSON header of each checkpoint is read to detect its architecture, no tensors are loaded.
+Hashes are cached in models/.hashes.json by file size and modification time, so re-running the
+script only reads new or changed checkpoints in full. Entries already in config.json keep any
+fields you edited, such as the name or the is_nsfw flag.
 
 The generated config.json is used by the API to load and manage available models. Keep in mind that
-this script only assists in generating the config file, you will need to fill in the pipeline, the
-is_nsfw flag and if you wish, the name.
+this script only assists in generating the config file, you will need to fill in the is_nsfw flag,
+the pipeline of any checkpoint that could not be recognised and, if you wish, the name.
 """
 
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from modules.checkpoint_inspection import inspect_checkpoint
 
 models_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+hash_index_path = os.path.join(models_path, ".hashes.json")
 
 if not os.path.exists(models_path):
     raise Exception("Can't find models folder!")
 
+existing_models = {}
+if os.path.exists("config.json"):
+    with open("config.json", "r", encoding="UTF-8") as f:
+        existing_models = {model["path"]: model for model in json.load(f)}
+
+model_files = sorted(model_file for model_file in os.listdir(models_path) if model_file.endswith(".safetensors"))
+
+# Hashing is bound by disk reads, and hashlib releases the GIL while it
+# works, so threads are enough to keep several drives or cores busy.
+with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+    inspections = list(executor.map(
+        lambda model_file: inspect_checkpoint(os.path.join(models_path, model_file), hash_index_path),
+        model_files
+    ))
+
 model_jsons = []
 
-for model_file in os.listdir(models_path):
-    if model_file.endswith(".safetensors"):
-        model_json = {
-            "id": model_file.replace(".safetensors", ""),
-            "name": model_file.replace(".safetensors", ""),
-            "pipeline": "PIPELINE_HERE",
-            "path": f"./models/{model_file}",
-            "is_nsfw": False
-        }
-        model_jsons.append(model_json)
-        
+for model_file, inspection in zip(model_files, inspections):
+    path = f"./models/{model_file}"
+    model_json = existing_models.get(path, {
+        "id": model_file.replace(".safetensors", ""),
+        "name": model_file.replace(".safetensors", ""),
+        "pipeline": "PIPELINE_HERE",
+        "path": path,
+        "is_nsfw": False
+    })
+    if inspection["pipeline"] is not None and model_json["pipeline"] == "PIPELINE_HERE":
+        model_json["pipeline"] = inspection["pipeline"]
+    model_json["architecture"] = inspection["architecture"]
+    model_json["parameters"] = inspection["parameters"]
+    model_json["memory_bytes"] = inspection["memory_bytes"]
+    model_json["sha256"] = inspection["sha256"]
+    if inspection["architecture"] is None:
+        print(f"Could not recognise the architecture of {model_file}, please fill in its pipeline.")
+    elif inspection["pipeline"] is None:
+        kind = "an inpainting" if inspection["inpainting"] else f"an {inspection['architecture']}"
+        print(
+            f"Warning: {model_file} is {kind} checkpoint, which the API cannot use to generate images from text. "
+            "Its pipeline has been left as PIPELINE_HERE."
+        )
+    model_jsons.append(model_json)
+
 with open("config.json", "w") as f:
-    json.dump(model_jsons, f, indent=4)
\ No newline at end of file
+    json.dump(model_jsons, f, indent=4)
@@ -0,0 +1,64 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+"""
+Runs the inference service in a child process and restarts it whenever it
+exits, so a crash inside torch only costs the jobs in flight, which the job
+journal queues again. HTTP frontends started with INFERENCE_SOCKET set to the
+same path forward their jobs to it.
+
+Usage, from the api directory:
+    python3 inference_server.py
+    INFERENCE_SOCKET=/tmp/ausonia_inference.sock fastapi run server.py --workers 4
+"""
+
+import multiprocessing
+import os
+import signal
+import time
+from modules import general
+from modules.inference_service import run_service
+
+LOGGER = general.get_logger()
+DEFAULT_SOCKET_PATH = "/tmp/ausonia_inference.sock"
+MIN_RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+# A service that stays up for this long is considered healthy again, and its
+# next crash is restarted without any back-off.
+HEALTHY_UPTIME = 300.0
+
+def main():
+    socket_path = os.environ.get("INFERENCE_SOCKET", DEFAULT_SOCKET_PATH)
+    # Spawned children start from a fresh interpreter, so no CUDA state is
+    # inherited from this process.
+    context = multiprocessing.get_context("spawn")
+    stopping = False
+    service = None
+
+    def stop(_signum, _frame):
+        nonlocal stopping
+        stopping = True
+        if service is not None and service.is_alive():
+            service.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    restart_delay = MIN_RESTART_DELAY
+    while not stopping:
+        service = context.Process(target=run_service, args=(socket_path,), name="inference-service")
+        started_at = time.monotonic()
+        service.start()
+        service.join()
+        if stopping:
+            break
+        if time.monotonic() - started_at > HEALTHY_UPTIME:
+            restart_delay = MIN_RESTART_DELAY
+        LOGGER.error(
+            f"Inference service exited with code {service.exitcode}, restarting in {restart_delay:.0f}s."
+        )
+        time.sleep(restart_delay)
+        restart_delay = min(restart_delay * 2, MAX_RESTART_DELAY)
+
+if __name__ == "__main__":
+    main()
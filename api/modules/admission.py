@@ -0,0 +1,128 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+"""
+Admission control for the job queue. Every job is given a work estimate, in
+units of one denoising step of a 512x512 Stable Diffusion 1.x image, and a
+peak memory estimate. Jobs are turned away when the queued work would take
+longer than the configured budget to clear, or when they would not fit on any
+worker at all.
+"""
+
+import math
+import threading
+from typing import Optional
+
+REFERENCE_PIXELS = 512 * 512
+# Relative per-step cost, fp16 weight size and activation memory per output
+# pixel of each pipeline class. Activations are measured at the peak of the
+# pipeline call, which is the VAE decode for large images.
+MODEL_CLASSES = {
+    "StableDiffusionPipeline": {
+        "cost": 1.0,
+        "weight_bytes": int(2.1 * 1024 ** 3),
+        "activation_bytes_per_pixel": 6 * 1024
+    },
+    "StableDiffusionXLPipeline": {
+        "cost": 2.5,
+        "weight_bytes": int(6.9 * 1024 ** 3),
+        "activation_bytes_per_pixel": 3 * 1024
+    }
+}
+DEFAULT_MODEL_CLASS = "StableDiffusionPipeline"
+# With model CPU offload only one component sits on the GPU at a time, and
+# the UNet is by far the largest of them.
+OFFLOADED_WEIGHT_FRACTION = 0.75
+
+def get_model_class(model: dict) -> dict:
+    return MODEL_CLASSES.get(model["pipeline"], MODEL_CLASSES[DEFAULT_MODEL_CLASS])
+
+def estimate_work(job_data: dict, model: dict, steps: Optional[int] = None) -> float:
+    """
+    Estimates how much work a job is, as pixels times steps times the cost of
+    the model's class, for each image the job asks for. A model's config
+    entry can set its own "cost_factor".
+
+    Args:
+        job_data: The job's request data.
+        model: The configuration entry of the job's model.
+        steps: The number of steps the job will actually run, if it differs
+            from the requested number.
+
+    Returns:
+        The job's work, in 512x512 SD 1.x step units.
+    """
+    steps = job_data["steps"] if steps is None else steps
+    cost = model.get("cost_factor", get_model_class(model)["cost"])
+    pixels = job_data["width"] * job_data["height"] * job_data.get("num_images", 1)
+    return pixels / REFERENCE_PIXELS * steps * cost
+
+def estimate_peak_memory(job_data: dict, model: dict, offloaded: bool) -> int:
+    """
+    Estimates the peak memory a job needs on a worker, from the model's
+    weights and the activations for the requested image size and number of
+    images, which are all generated in the same pipeline call. A model's
+    config entry can give its fp16 weight size as "memory_bytes", which
+    create_config.py fills in from the checkpoint.
+
+    Args:
+        job_data: The job's request data.
+        model: The configuration entry of the job's model.
+        offloaded: Whether the worker offloads idle components to the CPU.
+
+    Returns:
+        The estimated peak memory, in bytes.
+    """
+    model_class = get_model_class(model)
+    weight_bytes = model.get("memory_bytes", model_class["weight_bytes"])
+    if offloaded:
+        weight_bytes *= OFFLOADED_WEIGHT_FRACTION
+    pixels = job_data["width"] * job_data["height"] * job_data.get("num_images", 1)
+    activation_bytes = pixels * model_class["activation_bytes_per_pixel"]
+    return int(weight_bytes + activation_bytes)
+
+class AdmissionController:
+    def __init__(self, max_queued_seconds: float, seconds_per_unit: float, smoothing: float = 0.2):
+        self.max_queued_seconds = max_queued_seconds
+        self.seconds_per_unit = seconds_per_unit
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+
+    def record(self, work: float, seconds: float):
+        """
+        Folds a finished batch into the running estimate of seconds per work
+        unit, so the budget follows the real speed of the hardware.
+
+        Args:
+            work: The total work of the batch.
+            seconds: How long the batch took.
+        """
+        if work <= 0:
+            return
+        with self._lock:
+            self.seconds_per_unit += self.smoothing * (seconds / work - self.seconds_per_unit)
+
+    def estimate_seconds(self, work: float, num_workers: int) -> float:
+        with self._lock:
+            return work * self.seconds_per_unit / max(1, num_workers)
+
+    def get_retry_after(self, queued_work: float, job_work: float, num_workers: int) -> Optional[int]:
+        """
+        Decides whether a job fits in the queue's time budget.
+
+        Args:
+            queued_work: The total work of the queued and running jobs.
+            job_work: The work of the new job.
+            num_workers: The number of workers sharing the queue.
+
+        Returns:
+            None if the job should be admitted, otherwise the number of
+            seconds after which enough work should have cleared for it.
+        """
+        if self.max_queued_seconds <= 0:
+            return None
+        backlog_seconds = self.estimate_seconds(queued_work + job_work, num_workers)
+        if backlog_seconds <= self.max_queued_seconds:
+            return None
+        return max(1, math.ceil(backlog_seconds - self.max_queued_seconds))
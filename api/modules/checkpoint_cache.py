@@ -0,0 +1,80 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import os
+import shutil
+import threading
+from typing import Any, Optional
+import diffusers
+import torch
+from modules.checkpoint_inspection import get_file_hash
+
+_CONVERSION_LOCKS = {}
+_CONVERSION_LOCKS_LOCK = threading.Lock()
+
+def _get_conversion_lock(key: str) -> threading.Lock:
+    with _CONVERSION_LOCKS_LOCK:
+        return _CONVERSION_LOCKS.setdefault(key, threading.Lock())
+
+def get_converted_path(model: dict, cache_dir: str, auth_token: Optional[str] = None) -> str:
+    """
+    Returns the directory holding a diffusers-format copy of a model's single
+    file checkpoint, converting it first if it isn't there yet. The directory
+    is keyed by the checkpoint's hash, the pipeline class and the diffusers
+    version, so a changed file or a diffusers upgrade gets a fresh conversion.
+    Weights are stored as fp16 safetensors, which from_pretrained memory maps.
+
+    Args:
+        model: The configuration entry of the model.
+        cache_dir: The directory conversions are stored under.
+        auth_token: An optional HuggingFace token for fetching configs.
+
+    Returns:
+        The path of the converted pipeline directory.
+    """
+    checkpoint_hash = get_file_hash(model["path"], os.path.join(cache_dir, "hashes.json"))
+    key = f"{checkpoint_hash[:16]}-{model['pipeline']}-diffusers-{diffusers.__version__}"
+    converted_path = os.path.join(cache_dir, key)
+    with _get_conversion_lock(key):
+        if os.path.exists(os.path.join(converted_path, "model_index.json")):
+            return converted_path
+        pipe_class = getattr(diffusers, model["pipeline"])
+        kwargs = {"token": auth_token} if auth_token is not None else {}
+        pipe = pipe_class.from_single_file(
+            model["path"],
+            torch_dtype=torch.float16,
+            use_safetensors=True,
+            **kwargs
+        )
+        # Write to a temporary directory first, so a crash mid-conversion
+        # never leaves a half written pipeline that looks complete.
+        temporary_path = f"{converted_path}.tmp"
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        pipe.save_pretrained(temporary_path, safe_serialization=True)
+        del pipe
+        shutil.rmtree(converted_path, ignore_errors=True)
+        os.replace(temporary_path, converted_path)
+    return converted_path
+
+def load_converted_pipeline(model: dict, cache_dir: str, torch_dtype: torch.dtype,
+                            auth_token: Optional[str] = None) -> Any:
+    """
+    Loads a model's pipeline through the conversion cache, using the fast
+    from_pretrained path instead of parsing the single file checkpoint.
+
+    Args:
+        model: The configuration entry of the model.
+        cache_dir: The directory conversions are stored under.
+        torch_dtype: The dtype to load the weights in.
+        auth_token: An optional HuggingFace token for fetching configs.
+
+    Returns:
+        The loaded pipeline.
+    """
+    pipe_class = getattr(diffusers, model["pipeline"])
+    return pipe_class.from_pretrained(
+        get_converted_path(model, cache_dir, auth_token),
+        torch_dtype=torch_dtype,
+        use_safetensors=True
+    )
@@ -0,0 +1,172 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+"""
+Works out what a .safetensors checkpoint contains from its JSON header alone,
+without loading any tensors. A safetensors file starts with the length of
+its header as a little-endian 64-bit integer, followed by the header, which
+maps every tensor name to its dtype, shape and byte range.
+"""
+
+import hashlib
+import json
+import math
+import os
+import struct
+import threading
+from typing import Optional
+
+HASH_CHUNK_SIZE = 16 * 1024 ** 2
+MAX_HEADER_BYTES = 100 * 1024 ** 2
+FP16_BYTES = 2
+# The cross-attention key projection of the first transformer block in each
+# architecture. Its input width is the size of the text embeddings the UNet
+# was trained on, which tells the architectures apart.
+CONTEXT_PROBES = (
+    ("model.diffusion_model.input_blocks.1.1.transformer_blocks.0.attn2.to_k.weight", {768: "sd1", 1024: "sd2"}),
+    ("model.diffusion_model.input_blocks.4.1.transformer_blocks.0.attn2.to_k.weight", {
+        2048: "sdxl",
+        1280: "sdxl-refiner"
+    })
+)
+INPUT_CONV_KEY = "model.diffusion_model.input_blocks.0.0.weight"
+INPAINT_INPUT_CHANNELS = 9
+# The API only generates images from text, so refiner and inpainting
+# checkpoints are recognised but given no pipeline.
+PIPELINE_CLASSES = {
+    "sd1": "StableDiffusionPipeline",
+    "sd2": "StableDiffusionPipeline",
+    "sdxl": "StableDiffusionXLPipeline"
+}
+# Checkpoints saved during training may carry a second, averaged copy of the
+# UNet, which diffusers never loads.
+IGNORED_PREFIXES = ("model_ema.",)
+
+_HASH_INDEX_LOCK = threading.Lock()
+
+def read_safetensors_header(path: str) -> dict:
+    """
+    Reads the JSON header of a safetensors file.
+
+    Args:
+        path: The path of the file.
+
+    Returns:
+        The header, mapping tensor names to their "dtype", "shape" and
+        "data_offsets", plus an optional "__metadata__" entry.
+
+    Raises:
+        ValueError: If the file is not a valid safetensors file.
+    """
+    with open(path, "rb") as f:
+        length_bytes = f.read(8)
+        if len(length_bytes) != 8:
+            raise ValueError(f"'{path}' is too short to be a safetensors file")
+        (header_length,) = struct.unpack("<Q", length_bytes)
+        if header_length > MAX_HEADER_BYTES:
+            raise ValueError(f"'{path}' has an implausibly large header")
+        return json.loads(f.read(header_length))
+
+def detect_architecture(header: dict) -> Optional[str]:
+    """
+    Detects a checkpoint's architecture from its tensor names and shapes.
+
+    Args:
+        header: The checkpoint's safetensors header.
+
+    Returns:
+        One of "sd1", "sd2", "sdxl" or "sdxl-refiner", or None if the
+        checkpoint is not a recognised Stable Diffusion checkpoint.
+    """
+    for key, architectures in CONTEXT_PROBES:
+        tensor = header.get(key)
+        if tensor is not None and len(tensor["shape"]) == 2:
+            architecture = architectures.get(tensor["shape"][1])
+            if architecture is not None:
+                return architecture
+    return None
+
+def is_inpainting(header: dict) -> bool:
+    tensor = header.get(INPUT_CONV_KEY)
+    return tensor is not None and len(tensor["shape"]) == 4 and tensor["shape"][1] == INPAINT_INPUT_CHANNELS
+
+def count_parameters(header: dict) -> int:
+    return sum(
+        math.prod(tensor["shape"])
+        for name, tensor in header.items()
+        if name != "__metadata__" and not name.startswith(IGNORED_PREFIXES)
+    )
+
+def get_file_hash(path: str, index_path: str) -> str:
+    """
+    Computes the SHA-256 of a file, reusing the hash recorded in an index file
+    for as long as the file's size and modification time are unchanged, so
+    large checkpoints are only read in full once.
+
+    Args:
+        path: The file to hash.
+        index_path: The JSON file the known hashes are kept in.
+
+    Returns:
+        The hex SHA-256 digest of the file.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    with _HASH_INDEX_LOCK:
+        index = _read_hash_index(index_path)
+        known = index.get(path)
+        if known is not None and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime:
+            return known["sha256"]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    sha256 = digest.hexdigest()
+    with _HASH_INDEX_LOCK:
+        # Other threads may have added hashes while this file was read.
+        index = _read_hash_index(index_path)
+        index[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        temporary_path = f"{index_path}.tmp"
+        with open(temporary_path, "w", encoding="UTF-8") as f:
+            json.dump(index, f, indent=4)
+        os.replace(temporary_path, index_path)
+    return sha256
+
+def _read_hash_index(index_path: str) -> dict:
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, "r", encoding="UTF-8") as f:
+        return json.load(f)
+
+def inspect_checkpoint(path: str, hash_index_path: str) -> dict:
+    """
+    Describes a checkpoint for its config.json entry.
+
+    Args:
+        path: The path of the .safetensors checkpoint.
+        hash_index_path: The JSON file hashes are cached in.
+
+    Returns:
+        A dictionary with the checkpoint's "architecture" (None if unknown),
+        whether it is an "inpainting" checkpoint, the diffusers text-to-image
+        "pipeline" class (None if unknown or unsupported), number of
+        "parameters", estimated fp16 weight size as "memory_bytes", and
+        "sha256".
+    """
+    header = read_safetensors_header(path)
+    architecture = detect_architecture(header)
+    inpainting = is_inpainting(header)
+    pipeline = None
+    if architecture is not None and not inpainting:
+        pipeline = PIPELINE_CLASSES.get(architecture)
+    parameters = count_parameters(header)
+    return {
+        "architecture": architecture,
+        "inpainting": inpainting,
+        "pipeline": pipeline,
+        "parameters": parameters,
+        "memory_bytes": parameters * FP16_BYTES,
+        "sha256": get_file_hash(path, hash_index_path)
+    }
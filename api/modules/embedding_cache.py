@@ -0,0 +1,105 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import inspect
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+import torch
+
+class TextEmbedding:
+    def __init__(self, prompt_embeds: torch.Tensor, pooled_prompt_embeds: Optional[torch.Tensor]):
+        self.prompt_embeds = prompt_embeds
+        self.pooled_prompt_embeds = pooled_prompt_embeds
+
+def uses_pooled_embeddings(pipe: Any) -> bool:
+    return "pooled_prompt_embeds" in inspect.signature(pipe.__call__).parameters
+
+class EmbeddingCache:
+    def __init__(self, max_entries: int):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pipe: Any, text: str, is_negative: bool = False) -> TextEmbedding:
+        """
+        Returns the text encoder output for a piece of text, encoding it with
+        the pipeline's text encoders on a miss.
+
+        Args:
+            pipe: The pipeline the embeddings belong to.
+            text: The prompt or negative prompt to encode.
+            is_negative: Whether the text is a negative prompt. Pipelines that
+                zero out empty negative prompts get zeros instead of the
+                encoding of an empty string, matching passing None.
+
+        Returns:
+            The cached TextEmbedding.
+        """
+        key = (text, is_negative)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return embedding
+            self.misses += 1
+        embedding = self._encode(pipe, text, is_negative)
+        with self._lock:
+            self._entries[key] = embedding
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return embedding
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries)
+            }
+
+    @staticmethod
+    def _encode(pipe: Any, text: str, is_negative: bool) -> TextEmbedding:
+        pooled = uses_pooled_embeddings(pipe)
+        with torch.no_grad():
+            encoded = pipe.encode_prompt(
+                prompt=text,
+                device=pipe._execution_device,  # pylint: disable=W0212
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=False
+            )
+        if not pooled:
+            return TextEmbedding(encoded[0], None)
+        prompt_embeds, pooled_prompt_embeds = encoded[0], encoded[2]
+        if is_negative and text == "" and pipe.config.get("force_zeros_for_empty_prompt", False):
+            prompt_embeds = torch.zeros_like(prompt_embeds)
+            pooled_prompt_embeds = torch.zeros_like(pooled_prompt_embeds)
+        return TextEmbedding(prompt_embeds, pooled_prompt_embeds)
+
+def build_embedding_kwargs(pipe: Any, prompts: list[TextEmbedding], negatives: list[TextEmbedding]) -> dict:
+    """
+    Stacks cached embeddings for a batch into the keyword arguments a
+    pipeline call expects in place of prompt strings.
+
+    Args:
+        pipe: The pipeline the batch will run on.
+        prompts: The embedding of each job's prompt.
+        negatives: The embedding of each job's negative prompt.
+
+    Returns:
+        The embedding keyword arguments for the pipeline call.
+    """
+    kwargs = {
+        "prompt_embeds": torch.cat([embedding.prompt_embeds for embedding in prompts]),
+        "negative_prompt_embeds": torch.cat([embedding.prompt_embeds for embedding in negatives])
+    }
+    if uses_pooled_embeddings(pipe):
+        kwargs["pooled_prompt_embeds"] = torch.cat([embedding.pooled_prompt_embeds for embedding in prompts])
+        kwargs["negative_pooled_prompt_embeds"] = torch.cat(
+            [embedding.pooled_prompt_embeds for embedding in negatives]
+        )
+    return kwargs
@@ -3,6 +3,7 @@
 # ----------------------------------------------------------#
 
 import json
+import logging
 
 def get_negative_prompt():
     with open("negative_prompt.txt", "r", encoding="UTF-8") as f:
@@ -10,7 +11,20 @@ def get_negative_prompt():
         negative_prompt = ", ".join(line.strip() for line in lines)
     return negative_prompt
 
-def get_config():
-    with open("config.json", "r", encoding="UTF-8") as f:
+def get_config(path: str = "config.json"):
+    with open(path, "r", encoding="UTF-8") as f:
         config = json.load(f)
     return config
+
+def get_logger() -> logging.Logger:
+    logger = logging.getLogger("Ausonia.API")
+    logger.setLevel(logging.INFO)
+    # Check if the logger already has handlers to avoid duplicates
+    if not logger.hasHandlers():
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s.%(msecs)03d [%(levelname)s] %(message)s",
+            datefmt="%H:%M:%S"
+        ))
+        logger.addHandler(handler)
+    return logger
@@ -0,0 +1,71 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import io
+from PIL import Image
+
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg")
+}
+
+def get_variant_key(image_format: str, quality: int, lossless: bool) -> str:
+    """
+    Builds the key an encoded variant of an image is cached under. Options
+    that do not affect the output of a format are left out of the key.
+
+    Args:
+        image_format: The output format, one of "png", "webp" or "jpeg".
+        quality: The encoder quality, from 1 to 100.
+        lossless: Whether WebP output should be lossless.
+
+    Returns:
+        The cache key for the variant.
+    """
+    if image_format == "png":
+        return "png"
+    if image_format == "webp" and lossless:
+        return "webp-lossless"
+    return f"{image_format}-{quality}"
+
+def encode_image(image: Image.Image, image_format: str, quality: int = 90, lossless: bool = False) -> tuple[bytes, str]:
+    """
+    Encodes a PIL image into the requested output format.
+
+    Args:
+        image: The image to encode.
+        image_format: The output format, one of "png", "webp" or "jpeg".
+        quality: The encoder quality for lossy output, from 1 to 100.
+        lossless: Whether WebP output should be lossless.
+
+    Returns:
+        A tuple containing the encoded bytes and their MIME type.
+    """
+    pil_format, mime_type = IMAGE_FORMATS[image_format]
+    image_stream = io.BytesIO()
+    if image_format == "png":
+        image.save(image_stream, format=pil_format)
+    elif image_format == "webp":
+        image.save(image_stream, format=pil_format, quality=quality, lossless=lossless)
+    else:
+        image.convert("RGB").save(image_stream, format=pil_format, quality=quality)
+    return image_stream.getvalue(), mime_type
+
+def transcode_image(image_bytes: bytes, image_format: str, quality: int = 90, lossless: bool = False) -> tuple[bytes, str]:
+    """
+    Decodes stored image bytes and re-encodes them into another format.
+
+    Args:
+        image_bytes: The stored, encoded image.
+        image_format: The output format, one of "png", "webp" or "jpeg".
+        quality: The encoder quality for lossy output, from 1 to 100.
+        lossless: Whether WebP output should be lossless.
+
+    Returns:
+        A tuple containing the encoded bytes and their MIME type.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.load()
+        return encode_image(image, image_format, quality, lossless)
@@ -0,0 +1,99 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+"""
+Serves a DiffusionJobProcessor to HTTP frontends in other processes over a
+Unix socket. Messages are single lines of JSON: a request names a processor
+method and its arguments, and is answered with one line holding either the
+result or an error. Images never travel over the socket, the frontends read
+them from the shared results directory instead.
+"""
+
+import contextlib
+import json
+import os
+import socketserver
+from modules import general
+
+LOGGER = general.get_logger()
+# The processor methods frontends are allowed to call.
+SERVICE_METHODS = (
+    "is_ready",
+    "render_metrics",
+    "get_cache_stats",
+    "validate_job",
+    "get_retry_after",
+    "add_job",
+    "cancel_job",
+    "get_image_location",
+    "get_result",
+    "get_queue_info",
+    "reload_models"
+)
+WATCH_METHOD = "watch_result"
+
+def encode_message(message: dict) -> bytes:
+    return json.dumps(message).encode("UTF-8") + b"\n"
+
+def decode_message(line: bytes) -> dict:
+    return json.loads(line.decode("UTF-8"))
+
+class InferenceRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # pylint: disable=W0718
+        processor = self.server.processor
+        for line in self.rfile:
+            request = decode_message(line)
+            method = request.get("method")
+            args = request.get("args", [])
+            if method == WATCH_METHOD:
+                # Watching takes over the connection until the job finishes,
+                # after which the frontend closes it.
+                with contextlib.closing(processor.watch_result(*args)) as results:
+                    for result in results:
+                        message = {"keepalive": True} if result is None else {"result": result}
+                        self.wfile.write(encode_message(message))
+                        self.wfile.flush()
+                return
+            if method not in SERVICE_METHODS:
+                response = {"error": f"Unknown method '{method}'"}
+            else:
+                try:
+                    response = {"result": getattr(processor, method)(*args)}
+                except Exception as e:
+                    LOGGER.error(f"Inference service call '{method}' failed: {e}")
+                    response = {"error": str(e)}
+            self.wfile.write(encode_message(response))
+            self.wfile.flush()
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, processor):
+        self.processor = processor
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, InferenceRequestHandler)
+
+def run_service(socket_path: str):
+    """
+    Runs a job processor and serves it on a Unix socket until the process is
+    stopped. Every result is written to disk so frontends can read images
+    directly. Meant to be the target of a supervised child process.
+
+    Args:
+        socket_path: The path of the Unix socket to listen on.
+    """
+    # pylint: disable=C0415
+    # The processor pulls in torch, which the supervising process must not
+    # import before it spawns this one.
+    from modules.job_processing import DiffusionJobProcessor
+    processor = DiffusionJobProcessor(persist_results=True)
+    processor.start_processing()
+    with InferenceServer(socket_path, processor) as server:
+        LOGGER.info(f"Inference service listening on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            processor.stop_processing()
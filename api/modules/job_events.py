@@ -0,0 +1,88 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import asyncio
+import queue
+import threading
+
+class JobEventBroker:
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        """
+        Subscribes to the status changes of a job. Must be called from the
+        event loop that will consume the returned queue.
+
+        Args:
+            job_id: The ID of the job to watch.
+
+        Returns:
+            A queue that receives the job's new status each time it changes.
+        """
+        subscription = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._subscribers.setdefault(job_id, []).append((loop, subscription))
+        return subscription
+
+    def subscribe_blocking(self, job_id: str) -> queue.Queue:
+        """
+        Subscribes to the status changes of a job from a plain thread.
+
+        Args:
+            job_id: The ID of the job to watch.
+
+        Returns:
+            A thread-safe queue that receives the job's new status each time
+            it changes.
+        """
+        subscription = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(job_id, []).append((None, subscription))
+        return subscription
+
+    def unsubscribe(self, job_id: str, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(job_id, [])
+            self._subscribers[job_id] = [
+                subscriber for subscriber in subscribers if subscriber[1] is not subscription
+            ]
+            if not self._subscribers[job_id]:
+                del self._subscribers[job_id]
+
+    def publish(self, job_id: str, status: str):
+        """
+        Notifies every subscriber of a job that its status changed. Safe to
+        call from any thread.
+
+        Args:
+            job_id: The ID of the job that changed.
+            status: The job's new status.
+        """
+        with self._lock:
+            subscribers = list(self._subscribers.get(job_id, []))
+        for loop, subscription in subscribers:
+            if loop is None:
+                subscription.put_nowait(status)
+                continue
+            try:
+                loop.call_soon_threadsafe(subscription.put_nowait, status)
+            except RuntimeError:
+                # The subscriber's event loop has already been closed.
+                pass
+
+    def publish_all(self, status: str):
+        """
+        Notifies every subscriber of every job, for changes that affect all
+        of them at once, such as the queue moving forward.
+
+        Args:
+            status: The status to publish.
+        """
+        with self._lock:
+            job_ids = list(self._subscribers.keys())
+        for job_id in job_ids:
+            self.publish(job_id, status)
@@ -0,0 +1,158 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+"""
+A durable journal of submitted jobs, kept in an embedded SQLite database in
+WAL mode. It records each job's request, its status transitions and where its
+result was written, so that a restarted API can requeue unfinished jobs and
+keep serving finished ones until they expire.
+
+With WAL and synchronous=NORMAL a commit is an append to the write-ahead log
+without an fsync, which keeps journaling a submission well under a
+millisecond. Committed jobs survive the API process crashing, but not a power
+loss of the host.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    cache_key TEXT,
+    status TEXT NOT NULL,
+    record TEXT,
+    submitted_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at);
+"""
+
+class JournaledJob:
+    def __init__(self, job_id: str, data: dict, cache_key: Optional[str], status: str,
+                 record: Optional[dict], submitted_at: float, finished_at: Optional[float]):
+        self.job_id = job_id
+        self.data = data
+        self.cache_key = cache_key
+        self.status = status
+        self.record = record
+        self.submitted_at = submitted_at
+        self.finished_at = finished_at
+
+class JobJournal:
+    def __init__(self, path: str):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+
+    def add(self, job_id: str, job_data: dict, cache_key: Optional[str]):
+        """
+        Records a newly queued job.
+
+        Args:
+            job_id: The ID of the job.
+            job_data: The job's request data.
+            cache_key: The job's result cache key, if it has one.
+        """
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO jobs (id, data, cache_key, status, submitted_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, json.dumps(job_data), cache_key, "PENDING", time.time())
+            )
+
+    def set_status(self, job_id: str, status: str, record: Optional[dict] = None):
+        """
+        Records a status transition of a job. Terminal transitions also store
+        the job's result record, including the path of its image, and start
+        the job's expiry.
+
+        Args:
+            job_id: The ID of the job.
+            status: The new status of the job.
+            record: The job's result record, for terminal statuses.
+        """
+        finished_at = time.time() if status in ("COMPLETED", "FAILED") else None
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, record = ?, finished_at = ? WHERE id = ?",
+                (status, json.dumps(record) if record is not None else None, finished_at, job_id)
+            )
+
+    def add_finished(self, job_id: str, job_data: dict, record: dict):
+        """
+        Records a job that finished without being queued, such as one served
+        from the result cache.
+
+        Args:
+            job_id: The ID of the job.
+            job_data: The job's request data.
+            record: The job's result record.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO jobs (id, data, status, record, submitted_at, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(job_data), record["status"], json.dumps(record), now, now)
+            )
+
+    def purge_expired(self, ttl: float):
+        """
+        Deletes finished jobs older than the result TTL.
+
+        Args:
+            ttl: The result TTL, in seconds.
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM jobs WHERE finished_at < ?", (time.time() - ttl,))
+
+    def recover(self, ttl: float) -> tuple[list[JournaledJob], list[JournaledJob]]:
+        """
+        Reads back the journal after a restart, dropping expired jobs first.
+
+        Args:
+            ttl: The result TTL, in seconds.
+
+        Returns:
+            A tuple of the unfinished jobs, in submission order, and the
+            finished jobs that have not expired yet, in the order they finished.
+        """
+        self.purge_expired(ttl)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, data, cache_key, status, record, submitted_at, finished_at FROM jobs "
+                "ORDER BY COALESCE(finished_at, submitted_at)"
+            ).fetchall()
+        unfinished = []
+        finished = []
+        for job_id, data, cache_key, status, record, submitted_at, finished_at in rows:
+            job = JournaledJob(
+                job_id,
+                json.loads(data),
+                cache_key,
+                status,
+                json.loads(record) if record is not None else None,
+                submitted_at,
+                finished_at
+            )
+            if finished_at is None:
+                unfinished.append(job)
+            else:
+                finished.append(job)
+        unfinished.sort(key=lambda job: job.submitted_at)
+        return unfinished, finished
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -2,19 +2,54 @@
 # Licensed under the GNU Affero General Public License v3.0 #
 # ----------------------------------------------------------#
 
+import asyncio
 import threading
 import queue
 import uuid
-import base64
-import gc
-import io
+import collections
+import functools
+import json
 import os
+import random
 import time
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator, Optional
 import diffusers
+import psutil
 import torch
-from DeepCache import DeepCacheSDHelper
 from modules import general
+from modules.admission import AdmissionController, estimate_peak_memory, estimate_work
+from modules.job_events import JobEventBroker
+from modules.job_journal import JobJournal
+from modules.image_encoding import IMAGE_FORMATS, encode_image, get_variant_key, transcode_image
+from modules.embedding_cache import build_embedding_kwargs, uses_pooled_embeddings
+from modules.pipeline_cache import CachedPipeline, PipelineCache
+from modules.metrics import MetricsRegistry
+from modules.nsfw_screening import DEFAULT_LABELS_PATH, NsfwScreener, blur_image, read_labels
+from modules.model_registry import ModelRegistry
+from modules.pipeline_loader import load_pipeline
+from modules.previews import latents_to_previews
+from modules.speed_tiers import apply_speed_tier, get_speed_tier
+from modules.scheduler import FairScheduler
+from modules.result_cache import ResultCache, get_cache_key
+from modules.result_store import ResultStore, TERMINAL_STATUSES
+from modules.validation import SUPPORTED_PIPELINES, TokenizerCache, validate_job
+from modules.workers import InferenceWorker, parse_devices
+
+LOGGER = general.get_logger()
+WARMUP_SIZE = 512
+WARMUP_STEPS = 2
+JOURNAL_PURGE_INTERVAL = 60
+STOP_REASONS = {
+    "cancelled": "This job was cancelled.",
+    "expired": "This job passed its deadline before it could finish."
+}
+
+class BatchStopped(Exception):
+    """
+    Raised from the step callback to abandon a pipeline call once every job
+    in its batch has been cancelled or has passed its deadline.
+    """
 
 class DiffusionResult:
     def __init__(self, job_id, result):
@@ -22,26 +57,308 @@ class DiffusionResult:
         self.result = result
 
 class DiffusionJobProcessor:
-    def __init__(self):
-        self._job_queue = queue.Queue()
-        self._thread = threading.Thread(target=self._process_jobs)
+    def __init__(self, persist_results: bool = False, model_registry: Optional[ModelRegistry] = None):
+        self._job_queue = FairScheduler()
+        self._model_timings = collections.defaultdict(lambda: collections.deque(maxlen=20))
+        self._timings_lock = threading.Lock()
+        self._batch_max_size = max(1, int(os.environ.get("BATCH_MAX_SIZE", "4")))
+        self._batch_wait = float(os.environ.get("BATCH_WAIT_SECONDS", "0.05"))
+        self._preview_interval = int(os.environ.get("PREVIEW_INTERVAL", "5"))
+        self._setup_metrics()
+        self._thread = threading.Thread(target=self._dispatch_jobs)
         self._stop_event = threading.Event()
         self._thread.daemon = True
-        self._results_map = {}
-        self._config = general.get_config()
+        self._job_events = JobEventBroker()
+        # The job journal is optional, without it queued jobs and results are
+        # only kept in memory and are lost when the API restarts.
+        journal_path = os.environ.get("JOB_JOURNAL_PATH")
+        self._journal = JobJournal(journal_path) if journal_path else None
+        self._last_journal_purge = time.monotonic()
+        self._results_map = ResultStore(
+            results_dir=os.environ.get("RESULTS_DIR", "results"),
+            ttl=float(os.environ.get("RESULT_TTL_SECONDS", "3600")),
+            max_bytes=int(os.environ.get("RESULT_STORE_MAX_BYTES", str(256 * 1024 ** 2))),
+            spill_bytes=int(os.environ.get("RESULT_SPILL_BYTES", str(1024 ** 2))),
+            on_change=self._job_events.publish,
+            persist=persist_results or self._journal is not None
+        )
+        self._models = model_registry if model_registry is not None else ModelRegistry()
+        self._models.add_listener(self._on_models_changed)
+        self._negative_prompt = general.get_negative_prompt()
         self._auth_token = os.environ.get("AUTH_TOKEN", None)
+        self._tokenizers = TokenizerCache(self._auth_token)
+        # Setting CHECKPOINT_CACHE_DIR to an empty string loads single file
+        # checkpoints directly, without converting them.
+        self._checkpoint_cache_dir = os.environ.get("CHECKPOINT_CACHE_DIR", "checkpoint_cache") or None
+        self._result_cache = ResultCache(
+            max_bytes=int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(128 * 1024 ** 2)))
+        )
+        self._idle_condition = threading.Condition()
+        self._warmed_workers = 0
+        self._cancelled_jobs = set()
+        # Seeded requests identical to a job that is still queued or running
+        # are attached to it, keyed by that job's ID, and get its images
+        # under their own job IDs instead of being generated again.
+        self._attached_jobs = {}
+        self._attached_lock = threading.Lock()
+        # Jobs are turned away once the queued work would take longer than
+        # this to clear. Setting it to 0 turns admission control off.
+        self._admission = AdmissionController(
+            max_queued_seconds=float(os.environ.get("ADMISSION_MAX_QUEUED_SECONDS", "900")),
+            seconds_per_unit=float(os.environ.get("ADMISSION_SECONDS_PER_UNIT", "0.1"))
+        )
+        self._memory_headroom = float(os.environ.get("ADMISSION_MEMORY_HEADROOM", "0.9"))
+        # Screening is optional and only runs when a NudeNet model is given.
+        # Flagged images of models not marked as NSFW are blurred or blocked.
+        self._nsfw_model_path = os.environ.get("NSFW_MODEL_PATH")
+        self._nsfw_threshold = float(os.environ.get("NSFW_THRESHOLD", "0.5"))
+        self._nsfw_action = os.environ.get("NSFW_ACTION", "blur")
+        self._nsfw_labels_path = os.environ.get("NSFW_LABELS_PATH", DEFAULT_LABELS_PATH)
+        # Screening, encoding and storing a batch's images happen on this pool
+        # while the worker starts denoising its next batch. A worker waits
+        # before handing over another batch once this many are pending, so
+        # decoded images can't pile up in memory.
+        self._postprocess_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get("POSTPROCESS_THREADS", "2")),
+            thread_name_prefix="postprocess"
+        )
+        self._postprocess_slots = threading.BoundedSemaphore(int(os.environ.get("POSTPROCESS_MAX_PENDING", "4")))
+        # Batches handed to the pool and not yet stored, guarded by the idle
+        # condition like each worker's current batch.
+        self._postprocessing_batches = []
+        self._workers = []
+        for worker_id, (device, num_threads) in enumerate(parse_devices(os.environ.get("INFERENCE_DEVICES"))):
+            self._workers.append(InferenceWorker(
+                worker_id,
+                device,
+                num_threads,
+                PipelineCache(
+                    max_entries=int(os.environ.get("PIPELINE_CACHE_MAX_ENTRIES", "2")),
+                    max_bytes=int(os.environ.get("PIPELINE_CACHE_MAX_BYTES", str(16 * 1024 ** 3))),
+                    max_embeddings=int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", "256"))
+                )
+            ))
 
     def start_processing(self):
+        diffusers.utils.logging.set_verbosity_error()
+        diffusers.utils.logging.enable_default_handler()
+        diffusers.utils.logging.enable_explicit_format()
+        # Workers stay busy until their warm-up finishes, so the dispatcher
+        # won't hand them jobs while preloaded models are still loading.
+        with self._idle_condition:
+            for worker in self._workers:
+                worker.busy = True
+        if self._journal is not None:
+            self._recover_jobs()
+        if self._results_map.persist:
+            # Images a previous run wrote to disk are only kept if a recovered
+            # record still refers to them.
+            self._results_map.remove_orphaned_payloads()
+        for worker in self._workers:
+            worker.start(self._process_batch, self._stop_event, self._warm_up_worker)
         self._thread.start()
 
+    def _recover_jobs(self):
+        """
+        Restores the state recorded in the job journal before the last
+        shutdown or crash. Finished jobs are served again until their TTL
+        runs out, and jobs that were queued or running are queued again in
+        the order they were submitted.
+        """
+        unfinished, finished = self._journal.recover(self._results_map.ttl)
+        now = time.time()
+        for job in finished:
+            self._results_map.restore(job.job_id, job.record, now - job.finished_at)
+        for job in unfinished:
+            submitted_at = time.monotonic() - (now - job.submitted_at)
+            self._results_map.set(job.job_id, {
+                "status": "PENDING"
+            })
+            self._journal.set_status(job.job_id, "PENDING")
+            if job.cache_key is not None and self._attach_job(job.cache_key, job.job_id, job.data, submitted_at):
+                continue
+            self._job_queue.put(
+                {
+                    "id": job.job_id,
+                    "data": job.data,
+                    "cache_key": job.cache_key,
+                    "work": self._get_job_work(job.data),
+                    "submitted_at": submitted_at
+                },
+                submitter=(job.data.get("guild_id"), job.data.get("user_id")),
+                priority=job.data.get("priority", "normal")
+            )
+        if unfinished or finished:
+            LOGGER.info(f"Recovered {len(unfinished)} unfinished and {len(finished)} finished jobs from the journal.")
+
+    def is_ready(self) -> bool:
+        with self._idle_condition:
+            return self._warmed_workers == len(self._workers)
+
+    def _warm_up_worker(self, worker: InferenceWorker):
+        """
+        Loads every model flagged with "preload" in the configuration onto a
+        worker and runs a short generation with it, so that the first user
+        request doesn't pay for the model load, kernel selection and allocator
+        growth. Runs on the worker's own thread before it takes any jobs.
+
+        Args:
+            worker: The worker to warm up.
+        """
+        # pylint: disable=W0718
+        if self._nsfw_model_path:
+            try:
+                worker.nsfw_screener = NsfwScreener(
+                    self._nsfw_model_path,
+                    self._nsfw_threshold,
+                    read_labels(self._nsfw_labels_path)
+                )
+            except Exception as e:
+                LOGGER.error(f"Failed to load the NSFW screening model on {worker.device}: {e}")
+        for model in self._models.list():
+            if not model.get("preload", False):
+                continue
+            try:
+                start_time = time.perf_counter()
+                entry = self._get_pipeline(model, worker)
+                loaded_time = time.perf_counter()
+                apply_speed_tier(entry, get_speed_tier(model, "balanced"))
+                entry.pipe(
+                    **build_embedding_kwargs(
+                        entry.pipe,
+                        [entry.embeddings.get(entry.pipe, "warm up")],
+                        [entry.embeddings.get(entry.pipe, self._negative_prompt, is_negative=True)]
+                    ),
+                    width=WARMUP_SIZE,
+                    height=WARMUP_SIZE,
+                    num_inference_steps=WARMUP_STEPS
+                )
+                LOGGER.info(
+                    f"Preloaded '{model['id']}' on {worker.device} "
+                    f"(load: {loaded_time - start_time:.2f}s, warm-up: {time.perf_counter() - loaded_time:.2f}s)"
+                )
+            except Exception as e:
+                LOGGER.error(f"Failed to preload '{model['id']}' on {worker.device}: {e}")
+        with self._idle_condition:
+            worker.busy = False
+            self._warmed_workers += 1
+            self._idle_condition.notify_all()
+        if self.is_ready():
+            LOGGER.info("All workers are warmed up and ready.")
+
     def stop_processing(self):
         self._stop_event.set()
+        with self._idle_condition:
+            self._idle_condition.notify_all()
         self._thread.join()
+        for worker in self._workers:
+            worker.join()
+        # Batches that already finished denoising are still stored.
+        self._postprocess_pool.shutdown(wait=True)
+        for worker in self._workers:
+            worker.pipeline_cache.clear()
+        if self._journal is not None:
+            self._journal.close()
+
+    def _setup_metrics(self):
+        self._metrics = MetricsRegistry()
+        self._metric_queue_depth = self._metrics.gauge(
+            "ausonia_queue_depth", "Jobs waiting in the queue.", ("model",)
+        )
+        self._metric_in_flight = self._metrics.gauge(
+            "ausonia_jobs_in_flight", "Jobs currently being generated.", ("model",)
+        )
+        self._metric_jobs_completed = self._metrics.counter(
+            "ausonia_jobs_completed_total", "Jobs that completed successfully.", ("model",)
+        )
+        self._metric_jobs_failed = self._metrics.counter(
+            "ausonia_jobs_failed_total", "Jobs that failed.", ("model",)
+        )
+        self._metric_jobs_stopped = self._metrics.counter(
+            "ausonia_jobs_stopped_total", "Jobs cancelled or expired before finishing.", ("model", "reason")
+        )
+        self._metric_jobs_throttled = self._metrics.counter(
+            "ausonia_jobs_throttled_total", "Jobs turned away because the queue was over its budget.", ("model",)
+        )
+        self._metric_queue_seconds = self._metrics.histogram(
+            "ausonia_queue_seconds", "Time jobs spent waiting in the queue.", ("model",)
+        )
+        self._metric_model_load_seconds = self._metrics.histogram(
+            "ausonia_model_load_seconds", "Time taken to load a model's pipeline.", ("model",)
+        )
+        self._metric_denoise_seconds = self._metrics.histogram(
+            "ausonia_denoise_seconds", "Time spent in the denoising loop of each batch.", ("model",)
+        )
+        self._metric_decode_seconds = self._metrics.histogram(
+            "ausonia_decode_seconds", "Time spent decoding latents after denoising, per batch.", ("model",)
+        )
+        self._metric_postprocess_seconds = self._metrics.histogram(
+            "ausonia_postprocess_seconds",
+            "Time from a batch leaving its worker to its results being stored.",
+            ("model",)
+        )
+        self._metric_worker_idle_seconds = self._metrics.counter(
+            "ausonia_worker_idle_seconds_total",
+            "Time each worker spent waiting for a batch after warming up.",
+            ("worker", "device")
+        )
+        self._metric_encode_seconds = self._metrics.histogram(
+            "ausonia_image_encode_seconds", "Time taken to encode each output image.", ("model",)
+        )
+        self._metric_nsfw_screen_seconds = self._metrics.histogram(
+            "ausonia_nsfw_screen_seconds", "Time spent screening each batch of images for NSFW content.", ("model",)
+        )
+        self._metric_images_flagged = self._metrics.counter(
+            "ausonia_images_flagged_total", "Images flagged as NSFW, by the action taken.", ("model", "action")
+        )
+        self._metric_end_to_end_seconds = self._metrics.histogram(
+            "ausonia_end_to_end_seconds", "Time from submission to completion of each job.", ("model",)
+        )
+        self._metric_rss_bytes = self._metrics.gauge(
+            "ausonia_process_resident_memory_bytes", "Resident memory of the API process."
+        )
+        self._metric_device_allocated_bytes = self._metrics.gauge(
+            "ausonia_device_memory_allocated_bytes", "Memory allocated by tensors on each CUDA device.", ("device",)
+        )
+        self._metric_device_reserved_bytes = self._metrics.gauge(
+            "ausonia_device_memory_reserved_bytes", "Memory reserved by the allocator on each CUDA device.", ("device",)
+        )
+        self._metrics.add_collector(self._collect_metrics)
+
+    def _collect_metrics(self):
+        self._metric_queue_depth.clear()
+        for model_id, depth in self._job_queue.count_by(lambda job: job["data"]["model"]).items():
+            self._metric_queue_depth.set(depth, model_id)
+        self._metric_in_flight.clear()
+        for batch in self._get_active_batches():
+            self._metric_in_flight.inc(batch[0]["data"]["model"], amount=len(batch))
+        for worker in self._workers:
+            self._metric_worker_idle_seconds.set(worker.idle_seconds, str(worker.worker_id), worker.device)
+        self._metric_rss_bytes.set(psutil.Process().memory_info().rss)
+        if torch.cuda.is_available():
+            for index in range(torch.cuda.device_count()):
+                self._metric_device_allocated_bytes.set(torch.cuda.memory_allocated(index), f"cuda:{index}")
+                self._metric_device_reserved_bytes.set(torch.cuda.memory_reserved(index), f"cuda:{index}")
+
+    def render_metrics(self) -> str:
+        return self._metrics.render()
+
+    def get_cache_stats(self) -> dict:
+        return {
+            "workers": [
+                {
+                    "worker_id": worker.worker_id,
+                    "device": worker.device,
+                    **worker.pipeline_cache.get_stats()
+                }
+                for worker in self._workers
+            ],
+            "results": self._result_cache.get_stats()
+        }
 
     def _get_model_from_config(self, model_id: str) -> Optional[dict]:
         """
-        Looks up a model configuration in the internal configuration list
-        by its ID.
+        Looks up a model configuration in the model registry by its ID.
 
         Args:
             model_id: The ID of the model to look up.
@@ -50,168 +367,1053 @@ class DiffusionJobProcessor:
             A dictionary representing the model configuration if found,
             otherwise None.
         """
-        for model in self._config:
-            if model["id"] == model_id:
-                return model
+        return self._models.get(model_id)
+
+    def reload_models(self) -> dict:
+        """
+        Reloads config.json straight away, instead of waiting for the registry
+        to notice the file changed.
+
+        Returns:
+            A dictionary saying whether the catalog "changed", with its new
+            "etag" and number of "models".
+        """
+        changed = self._models.reload()
+        return {
+            "changed": changed,
+            "etag": self._models.etag,
+            "models": len(self._models.list())
+        }
+
+    def _on_models_changed(self, stale_ids: list[str]):
+        LOGGER.info(f"Reloaded the model catalog, evicting {len(stale_ids)} removed or changed models.")
+        if not stale_ids:
+            return
+        self._result_cache.invalidate_models(stale_ids)
+        for worker in self._workers:
+            worker.evict_later(stale_ids)
+
+    def _generate_job_id(self) -> str:
+        generated_uuid = str(uuid.uuid4())
+        while generated_uuid in self._results_map:
+            generated_uuid = str(uuid.uuid4())
+        return generated_uuid
+
+    def validate_job(self, job_data: dict) -> Optional[str]:
+        """
+        Validates a job's model, size, steps and prompt lengths before it is
+        queued, and checks that its estimated peak memory fits on at least one
+        worker.
+
+        Args:
+            job_data: A dictionary containing the job's request data.
+
+        Returns:
+            A message describing why the job is invalid, or None if it is valid.
+        """
+        model = self._get_model_from_config(job_data["model"])
+        error = validate_job(job_data, model, self._tokenizers)
+        if error is not None:
+            return error
+        if not any(
+            estimate_peak_memory(job_data, model, worker.is_cuda) <= worker.memory_bytes * self._memory_headroom
+            for worker in self._workers
+        ):
+            return "The image is too large to generate with this model, try a smaller size"
         return None
 
+    def get_retry_after(self, job_data: dict) -> Optional[int]:
+        """
+        Checks a validated job against the queue's time budget. Jobs whose
+        result is cached or already being produced cost nothing and are
+        always admitted.
+
+        Args:
+            job_data: A dictionary containing the job's request data.
+
+        Returns:
+            None if the job can be queued, otherwise how many seconds the
+            client should wait before trying again.
+        """
+        cache_key = get_cache_key(job_data)
+        if cache_key is not None and self._result_cache.contains(cache_key):
+            return None
+        running_work = sum(job["work"] for batch in self._get_active_batches() for job in batch)
+        queued_work = self._job_queue.total(lambda job: job["work"])
+        retry_after = self._admission.get_retry_after(
+            queued_work + running_work,
+            self._get_job_work(job_data),
+            len(self._workers)
+        )
+        if retry_after is not None:
+            self._metric_jobs_throttled.inc(job_data["model"])
+        return retry_after
+
+    def _get_job_work(self, job_data: dict) -> float:
+        model = self._get_model_from_config(job_data["model"])
+        if model is None:
+            return 0.0
+        tier = get_speed_tier(model, job_data.get("speed_tier", "balanced"))
+        return estimate_work(job_data, model, min(job_data["steps"], tier["max_steps"]))
+
     def add_job(self, job_data) -> str:
         """
         Adds a new job to the queue with the given data. Returns a unique job
         ID which can be used to retrieve the job result.
 
+        Jobs are queued per submitter, identified by the guild and user IDs in
+        the job data, and served round-robin within their priority class. Jobs
+        with an explicit seed are looked up in the result cache first: a hit
+        returns a job that is already complete, and a request identical to one
+        still queued or running is attached to it instead of queueing again.
+        An attached job keeps its own ID, deadline and cancellation, and gets
+        a copy of the running job's images.
+
         Args:
             job_data: A dictionary containing the model ID, prompt, negative
-                prompt, width, height, steps, and guidance scale for the job.
+                prompt, width, height, steps, guidance scale, submitter IDs
+                and priority for the job.
 
         Returns:
             A unique job ID which can be used to retrieve the job result.
         """
-        generated_uuid = str(uuid.uuid4())
-        while generated_uuid in self._results_map:
-            generated_uuid = str(uuid.uuid4())
-        self._job_queue.put({
-            "id": generated_uuid,
-            "data": job_data
-        })
-        self._results_map[generated_uuid] = {
+        cache_key = get_cache_key(job_data)
+        if cache_key is not None:
+            cached = self._result_cache.get(cache_key)
+            if cached is not None:
+                generated_uuid = self._generate_job_id()
+                self._results_map.complete(
+                    generated_uuid,
+                    cached.images,
+                    cached.mime_type,
+                    dict(cached.record, cached=True)
+                )
+                if self._journal is not None:
+                    self._journal.add_finished(generated_uuid, job_data, self._get_journal_record(generated_uuid))
+                return generated_uuid
+        generated_uuid = self._generate_job_id()
+        submitted_at = time.monotonic()
+        self._results_map.set(generated_uuid, {
             "status": "PENDING"
-        }
+        })
+        if self._journal is not None:
+            self._journal.add(generated_uuid, job_data, cache_key)
+        if cache_key is not None and self._attach_job(cache_key, generated_uuid, job_data, submitted_at):
+            return generated_uuid
+        self._job_queue.put(
+            {
+                "id": generated_uuid,
+                "data": job_data,
+                "cache_key": cache_key,
+                "work": self._get_job_work(job_data),
+                "submitted_at": submitted_at
+            },
+            submitter=(job_data.get("guild_id"), job_data.get("user_id")),
+            priority=job_data.get("priority", "normal")
+        )
         return generated_uuid
 
-    def get_result(self, job_id: str) -> dict:
+    def _attach_job(self, cache_key: str, job_id: str, job_data: dict, submitted_at: float) -> bool:
+        """
+        Claims a new job's cache key, or attaches the job to the queued or
+        running job that has already claimed it.
+
+        Args:
+            cache_key: The cache key of the new job.
+            job_id: The unique ID of the new job.
+            job_data: The data of the new job.
+            submitted_at: When the new job was submitted, from
+                time.monotonic().
+
+        Returns:
+            True if the job was attached to another job, or False if it
+            claimed the cache key and should be queued.
+        """
+        with self._attached_lock:
+            existing_job_id = self._result_cache.claim(cache_key, job_id, job_data["model"])
+            if existing_job_id is None:
+                return False
+            # Attached jobs carry no cache key, as the claim stays with the
+            # job doing the work.
+            self._attached_jobs.setdefault(existing_job_id, []).append({
+                "id": job_id,
+                "data": job_data,
+                "submitted_at": submitted_at
+            })
+            return True
+
+    def _detach_job(self, job_id: str) -> Optional[tuple[str, dict]]:
+        """
+        Detaches a job from the job it was attached to.
+
+        Args:
+            job_id: The unique ID of the attached job.
+
+        Returns:
+            A tuple of the ID of the job it was attached to and the attached
+            job itself, or None if the job was not attached to another job.
+        """
+        with self._attached_lock:
+            for target_id, attached_jobs in self._attached_jobs.items():
+                for attached_job in attached_jobs:
+                    if attached_job["id"] == job_id:
+                        attached_jobs.remove(attached_job)
+                        return target_id, attached_job
+        return None
+
+    def _get_attached_target(self, job_id: str) -> Optional[str]:
+        with self._attached_lock:
+            for target_id, attached_jobs in self._attached_jobs.items():
+                if any(attached_job["id"] == job_id for attached_job in attached_jobs):
+                    return target_id
+        return None
+
+    def _get_live_attached_jobs(self, job_id: str) -> list:
+        with self._attached_lock:
+            attached_jobs = list(self._attached_jobs.get(job_id, []))
+        return [attached_job for attached_job in attached_jobs if self._get_own_stop_reason(attached_job) is None]
+
+    def _get_journal_record(self, job_id: str) -> dict:
+        record = self._results_map.get_record(job_id)
+        record.pop("finished_at", None)
+        return record
+
+    def cancel_job(self, job_id: str) -> Optional[bool]:
+        """
+        Cancels a job. A queued job is removed from the queue straight away,
+        and a running job is stopped at its next denoising step. The work of
+        a job that other requests are attached to carries on for them, and is
+        only stopped once every one of them has been cancelled too.
+
+        Args:
+            job_id: The unique ID of the job to cancel.
+
+        Returns:
+            True if the job was cancelled, False if it had already finished,
+            or None if the job does not exist.
+        """
+        record = self._results_map.get_record(job_id)
+        if record is None:
+            return None
+        if record["status"] in TERMINAL_STATUSES:
+            return False
+        attached = self._detach_job(job_id)
+        if attached is not None:
+            target_id, attached_job = attached
+            self._stop_jobs([attached_job], "cancelled")
+            if target_id in self._cancelled_jobs and not self._get_live_attached_jobs(target_id):
+                self._remove_cancelled_job(target_id)
+            return True
+        self._cancelled_jobs.add(job_id)
+        live_attached_jobs = self._get_live_attached_jobs(job_id)
+        if live_attached_jobs:
+            # Attached jobs share the job's model.
+            self._metric_jobs_stopped.inc(live_attached_jobs[0]["data"]["model"], "cancelled")
+            self._record_failure(job_id, STOP_REASONS["cancelled"])
+            return True
+        self._remove_cancelled_job(job_id)
+        return True
+
+    def _remove_cancelled_job(self, job_id: str):
+        job = self._job_queue.remove(job_id)
+        if job is not None:
+            self._stop_jobs([job], "cancelled")
+            self._job_events.publish_all("PENDING")
+
+    def get_image(self, job_id: str, image_format: str, quality: int, lossless: bool,
+                  index: int = 0) -> Optional[tuple[bytes, str]]:
+        """
+        Retrieves one of the images of a completed job encoded in the
+        requested format. Each encoding is produced once and then cached
+        alongside the job's result.
+
+        Args:
+            job_id: The unique ID of the job to retrieve the image for.
+            image_format: The output format, one of "png", "webp" or "jpeg".
+            quality: The encoder quality for lossy output, from 1 to 100.
+            lossless: Whether WebP output should be lossless.
+            index: The position of the image among the job's images.
+
+        Returns:
+            A tuple containing the encoded bytes and their MIME type, or None
+            if the job has no such image.
+        """
+        record = self._results_map.get_record(job_id)
+        if record is None or record["status"] != "COMPLETED" or not 0 <= index < record["num_images"]:
+            return None
+        variant_key = get_variant_key(image_format, quality, lossless)
+        if record["mime_type"] == IMAGE_FORMATS[image_format][1] and variant_key == image_format:
+            image = self._results_map.get_image(job_id, index)
+            return (image, record["mime_type"]) if image is not None else None
+        variant = self._results_map.get_variant(job_id, index, variant_key)
+        if variant is not None:
+            return variant
+        image = self._results_map.get_image(job_id, index)
+        if image is None:
+            return None
+        data, mime_type = transcode_image(image, image_format, quality, lossless)
+        self._results_map.put_variant(job_id, index, variant_key, data, mime_type)
+        return data, mime_type
+
+    def get_image_location(self, job_id: str, index: int = 0) -> Optional[dict]:
+        """
+        Finds where one of the images of a completed job was written, so
+        another process sharing the results directory can read it without the
+        image being copied through the IPC channel. Only persistent result
+        stores write every image to disk.
+
+        Args:
+            job_id: The unique ID of the job.
+            index: The position of the image among the job's images.
+
+        Returns:
+            A dictionary with the absolute "image_path" and the "mime_type" of
+            the image, or None if the job has no such image on disk.
+        """
+        record = self._results_map.get_record(job_id)
+        if record is None or record["status"] != "COMPLETED" or not 0 <= index < record["num_images"]:
+            return None
+        image_path = record["image_paths"][index]
+        if image_path is None:
+            return None
+        return {
+            "image_path": os.path.abspath(image_path),
+            "mime_type": record["mime_type"]
+        }
+
+    def get_result(self, job_id: str, include_image: bool = True) -> dict:
         """
         Retrieves the result of a job with the given ID. If the job ID does not exist,
         an empty dictionary is returned.
 
         Args:
             job_id: The unique ID of the job to retrieve the result for.
+            include_image: Whether to embed the images as base64 data URLs.
+                Clients that download the images from /get_image can skip them.
+
+        Returns:
+            A dictionary containing the result of the job. The dictionary contains
+            a "status" key with a value of "PENDING", "PROCESSING", "COMPLETED" or
+            "FAILED". If the job completed, the dictionary will contain an "images"
+            key with each base64 encoded image, an "image" key with the first of
+            them and an "elapsed_time" key with the time the pipeline call took,
+            such as "4.21s". If the job failed, the dictionary will contain an
+            "error" key with an error message.
+        """
+        result = self._results_map.get(job_id, include_image)
+        if result.get("status") == "PENDING":
+            result.update(self._get_queue_position(job_id))
+        return result
+
+    def get_queue_info(self) -> dict:
+        in_flight = sum(len(batch) for batch in self._get_active_batches())
+        with self._idle_condition:
+            busy_workers = sum(1 for worker in self._workers if worker.busy)
+        with self._timings_lock:
+            model_timings = {
+                model_id: sum(timings) / len(timings)
+                for model_id, timings in self._model_timings.items() if timings
+            }
+        queued_work = self._job_queue.total(lambda job: job["work"])
+        return {
+            "queue_depth": len(self._job_queue),
+            "queue_depth_by_priority": self._job_queue.get_depths(),
+            "estimated_backlog_seconds": round(self._admission.estimate_seconds(queued_work, len(self._workers)), 1),
+            "in_flight": in_flight,
+            "workers": len(self._workers),
+            "busy_workers": busy_workers,
+            "average_seconds_per_image": model_timings
+        }
+
+    def _get_active_batches(self) -> list:
+        """
+        Lists the batches that are being denoised on a worker or are waiting
+        for post-processing, whose jobs are all still PROCESSING.
+
+        Returns:
+            The active batches, each a list of jobs.
+        """
+        with self._idle_condition:
+            batches = [worker.current_batch for worker in self._workers if worker.current_batch]
+            # A batch is briefly both a worker's current batch and handed off.
+            batches.extend(
+                batch for batch in self._postprocessing_batches
+                if not any(batch is current for current in batches)
+            )
+        return batches
+
+    def _record_timing(self, model_id: str, seconds: float):
+        with self._timings_lock:
+            self._model_timings[model_id].append(seconds)
+
+    def _estimate_seconds(self, model_id: str) -> Optional[float]:
+        with self._timings_lock:
+            timings = self._model_timings.get(model_id)
+            if timings:
+                return sum(timings) / len(timings)
+            all_timings = [timing for timings in self._model_timings.values() for timing in timings]
+        return sum(all_timings) / len(all_timings) if all_timings else None
+
+    def _get_queue_position(self, job_id: str) -> dict:
+        """
+        Works out where a pending job sits in the queue and roughly how long
+        it will take to finish, based on recent timings of each queued job's
+        model spread across the worker pool.
+
+        Args:
+            job_id: The unique ID of the pending job.
+
+        Returns:
+            A dictionary with the job's 1-based "position", the "queue_depth"
+            and an "eta_seconds" estimate, which is None until timings exist.
+        """
+        # An attached job waits for the job it is attached to.
+        jobs = self._job_queue.get_jobs_until(self._get_attached_target(job_id) or job_id)
+        if jobs is None:
+            return {}
+        estimates = [self._estimate_seconds(job["data"]["model"]) for job in jobs]
+        eta_seconds = None
+        if all(estimate is not None for estimate in estimates):
+            eta_seconds = round(sum(
+                estimate * job["data"].get("num_images", 1) for job, estimate in zip(jobs, estimates)
+            ) / len(self._workers), 1)
+        return {
+            "position": len(jobs),
+            "queue_depth": len(self._job_queue),
+            "eta_seconds": eta_seconds
+        }
+
+    async def stream_result(self, job_id: str, keepalive: float = 15.0) -> AsyncIterator[str]:
+        """
+        Streams the status of a job as Server-Sent Events. The current result
+        is sent straight away, then a new event is sent each time the worker
+        records a status change, until the job completes or fails. Events never
+        embed the image; clients download it from /get_image.
+
+        Args:
+            job_id: The unique ID of the job to stream.
+            keepalive: How often, in seconds, to send a comment line while the
+                job's status is unchanged, so idle connections stay open.
+
+        Yields:
+            Server-Sent Event frames containing the job's result as JSON.
+        """
+        subscription = self._job_events.subscribe(job_id)
+        try:
+            while True:
+                result = self.get_result(job_id, include_image=False)
+                yield f"data: {json.dumps(result)}\n\n"
+                if result.get("status", "FAILED") in TERMINAL_STATUSES:
+                    return
+                while True:
+                    try:
+                        await asyncio.wait_for(subscription.get(), timeout=keepalive)
+                        break
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                # Several transitions may have been published at once, only
+                # the latest one matters.
+                while not subscription.empty():
+                    subscription.get_nowait()
+        finally:
+            self._job_events.unsubscribe(job_id, subscription)
+
+    async def open_result_stream(self, job_id: str) -> AsyncIterator[str]:
+        """
+        Returns the Server-Sent Event stream of a job. Kept alongside
+        stream_result so the server can open streams the same way whether the
+        models run in this process or in a separate inference service.
+        """
+        return self.stream_result(job_id)
+
+    def watch_result(self, job_id: str, keepalive: float = 15.0) -> Iterator[Optional[dict]]:
+        """
+        The blocking counterpart of stream_result, for serving job updates to
+        other processes from a plain thread.
+
+        Args:
+            job_id: The unique ID of the job to watch.
+            keepalive: How often, in seconds, to yield None while the job's
+                status is unchanged.
+
+        Yields:
+            The job's result without its image each time it changes, or None
+            when the keepalive interval passes without a change.
+        """
+        subscription = self._job_events.subscribe_blocking(job_id)
+        try:
+            while True:
+                result = self.get_result(job_id, include_image=False)
+                yield result
+                if result.get("status", "FAILED") in TERMINAL_STATUSES:
+                    return
+                while True:
+                    try:
+                        subscription.get(timeout=keepalive)
+                        break
+                    except queue.Empty:
+                        yield None
+                while not subscription.empty():
+                    subscription.get_nowait()
+        finally:
+            self._job_events.unsubscribe(job_id, subscription)
+
+    def _get_pipeline(self, model: dict, worker: InferenceWorker) -> CachedPipeline:
+        expected_bytes = None
+        if "memory_bytes" in model:
+            # create_config.py records the fp16 size, CPU workers load fp32.
+            expected_bytes = model["memory_bytes"] * worker.torch_dtype.itemsize // 2
+        return worker.pipeline_cache.get(
+            model["id"],
+            functools.partial(self._load_pipeline, model, worker),
+            self._warm_embeddings,
+            expected_bytes
+        )
+
+    def _load_pipeline(self, model: dict, worker: InferenceWorker) -> tuple:
+        start_time = time.perf_counter()
+        loaded = load_pipeline(
+            model,
+            worker.device,
+            worker.torch_dtype,
+            self._auth_token,
+            self._checkpoint_cache_dir
+        )
+        self._metric_model_load_seconds.observe(time.perf_counter() - start_time, model["id"])
+        return loaded
+
+    def _warm_embeddings(self, entry: CachedPipeline):
+        """
+        Pre-encodes the server's default negative prompt, and the empty
+        negative prompt, as soon as a pipeline is loaded.
+
+        Args:
+            entry: The freshly loaded pipeline cache entry.
+        """
+        entry.embeddings.get(entry.pipe, self._negative_prompt, is_negative=True)
+        entry.embeddings.get(entry.pipe, "", is_negative=True)
+
+    @staticmethod
+    def _batch_key(job_data: dict) -> tuple:
+        return (
+            job_data["model"],
+            job_data["width"],
+            job_data["height"],
+            job_data["steps"],
+            job_data["cfg_scale"],
+            job_data.get("speed_tier", "balanced"),
+            job_data.get("num_images", 1)
+        )
+
+    def _next_batch(self) -> list:
+        """
+        Takes the next job to process, then waits for up to the batch wait
+        window to collect queued jobs that share the same model, size, steps,
+        guidance scale and number of images. Compatible jobs are taken in the
+        order the scheduler would have served them, and every other job keeps
+        its place. The batch size limit counts images rather than jobs.
 
         Returns:
-            A dictionary containing the result of the job. The dictionary may contain
-            a "status" key with a value of "SUCCESS" or "ERROR". If the job completed
-            successfully, the dictionary will contain an "image" key with the base64
-            encoded image and an "elapsed" key with the time it took to process the
-            job in seconds. If the job failed, the dictionary will contain an "error"
-            key with an error message.
+            A list of compatible jobs, containing at least one job.
+
+        Raises:
+            queue.Empty: If no job arrived within the polling timeout.
+        """
+        first_job = self._job_queue.get(timeout=1)
+        key = self._batch_key(first_job["data"])
+        max_jobs = max(1, self._batch_max_size // first_job["data"].get("num_images", 1))
+        return self._drop_stopped_jobs([first_job] + self._job_queue.take_matching(
+            lambda job: self._batch_key(job["data"]) == key,
+            max_jobs - 1,
+            self._batch_wait
+        ))
+
+    def _get_own_stop_reason(self, job: dict) -> Optional[str]:
+        if job["id"] in self._cancelled_jobs:
+            return "cancelled"
+        deadline = job["data"].get("deadline")
+        if deadline is not None and time.time() > deadline:
+            return "expired"
+        return None
+
+    def _get_stop_reason(self, job: dict) -> Optional[str]:
         """
-        return self._results_map.get(job_id, {})
+        Works out whether a job's work should stop. Work that other jobs are
+        attached to carries on until each of them has been cancelled or has
+        expired as well.
 
-    def _process_jobs(self):
+        Args:
+            job: The queued or running job.
+
+        Returns:
+            "cancelled" or "expired" if the work should stop, otherwise None.
         """
-        Continuously processes jobs from the job queue until a stop event is set.
-        
-        Each job contains data to perform inference using a specified model pipeline from 
-        the configuration. Results, including success status and the encoded image, are 
-        stored in the results map. If the pipeline for a model cannot be found, an error 
-        message is recorded.
+        reason = self._get_own_stop_reason(job)
+        if reason is None or self._get_live_attached_jobs(job["id"]):
+            return None
+        return reason
 
-        The function retrieves jobs from the queue, loads the appropriate model pipeline,
-        and generates an image based on the job's parameters. The image is then encoded 
-        in base64 format and stored in the results map along with the processing time.
+    def _get_waiting_jobs(self, job: dict) -> list:
+        """
+        Lists the jobs waiting for a running job's images: the job itself and
+        the jobs attached to it. Any of them that has been cancelled or has
+        expired while the work carries on for the others is stopped.
+
+        Args:
+            job: The running job.
+
+        Returns:
+            The jobs whose records follow the running job's progress.
+        """
+        waiting_jobs = []
+        reason = self._get_own_stop_reason(job)
+        if reason is None:
+            waiting_jobs.append(job)
+        elif not self._is_finished(job["id"]):
+            self._metric_jobs_stopped.inc(job["data"]["model"], reason)
+            self._record_failure(job["id"], STOP_REASONS[reason])
+        with self._attached_lock:
+            attached_jobs = self._attached_jobs.get(job["id"], [])
+            stopped_jobs = [
+                attached_job for attached_job in attached_jobs if self._get_own_stop_reason(attached_job) is not None
+            ]
+            for stopped_job in stopped_jobs:
+                attached_jobs.remove(stopped_job)
+            waiting_jobs.extend(attached_jobs)
+        for stopped_job in stopped_jobs:
+            self._stop_jobs([stopped_job], self._get_own_stop_reason(stopped_job))
+        return waiting_jobs
+
+    def _is_finished(self, job_id: str) -> bool:
+        record = self._results_map.get_record(job_id)
+        return record is not None and record["status"] in TERMINAL_STATUSES
+
+    def _drop_stopped_jobs(self, jobs: list) -> list:
+        """
+        Stops every job in a list that has been cancelled or has passed its
+        deadline, so no worker time is spent on it.
+
+        Args:
+            jobs: The jobs to check.
+
+        Returns:
+            The jobs that should still run.
+        """
+        remaining = []
+        for job in jobs:
+            reason = self._get_stop_reason(job)
+            if reason is None:
+                remaining.append(job)
+            else:
+                self._stop_jobs([job], reason)
+        return remaining
+
+    def _stop_jobs(self, jobs: list, reason: str):
+        for job in jobs:
+            if not self._is_finished(job["id"]):
+                self._metric_jobs_stopped.inc(job["data"]["model"], reason)
+        self._record_failures(jobs, STOP_REASONS[reason])
+
+    def _fail_unfinished_jobs(self, jobs: list):
+        self._fail_jobs(jobs, "An exception was thrown.")
+
+    def _fail_jobs(self, jobs: list, error: str):
+        for job in jobs:
+            if not self._is_finished(job["id"]):
+                self._metric_jobs_failed.inc(job["data"]["model"])
+        self._record_failures(jobs, error)
+
+    def _record_failures(self, jobs: list, error: str):
+        """
+        Records the failure of each job that has not finished yet, and of
+        the jobs attached to it. Attached jobs that were cancelled or have
+        expired are stopped for that reason instead.
+
+        Args:
+            jobs: The jobs whose work has failed or been stopped.
+            error: The error message to record.
+        """
+        for job in jobs:
+            # A job may be cancelled while running and then fail for another
+            # reason, so its cancellation is forgotten on every failure.
+            self._cancelled_jobs.discard(job["id"])
+            attached_jobs = []
+            if job.get("cache_key") is not None:
+                with self._attached_lock:
+                    self._result_cache.release(job["cache_key"], job["id"])
+                    attached_jobs = self._attached_jobs.pop(job["id"], [])
+            # A job's own result is stopped early when its work carries on for
+            # the jobs attached to it.
+            if not self._is_finished(job["id"]):
+                self._record_failure(job["id"], error)
+            for attached_job in attached_jobs:
+                reason = self._get_own_stop_reason(attached_job)
+                if reason is not None:
+                    self._stop_jobs([attached_job], reason)
+                else:
+                    self._fail_jobs([attached_job], error)
+
+    def _record_failure(self, job_id: str, error: str):
+        self._results_map.set(job_id, {
+            "status": "FAILED",
+            "error": error
+        })
+        if self._journal is not None:
+            self._journal.set_status(job_id, "FAILED", self._get_journal_record(job_id))
+
+    def _run_batch(self, worker: InferenceWorker, batch: list):
+        """
+        Runs a batch of compatible jobs through a single pipeline call on a
+        worker, then hands the decoded images to the post-processing pool,
+        which stores each job's images against its own job ID. Jobs asking
+        for several images get them from the same call, through the
+        pipeline's num_images_per_prompt.
+
+        Args:
+            worker: The worker running the batch.
+            batch: A list of jobs sharing the same model, size, steps,
+                guidance scale and number of images.
+        """
+        job_data = batch[0]["data"]
+        model = self._get_model_from_config(job_data["model"])
+        if model is None:
+            self._fail_jobs(batch, f"Model '{job_data['model']}' not found")
+            return
+        if not hasattr(diffusers, model["pipeline"]):
+            self._fail_jobs(batch, f"Pipeline '{model['pipeline']}' not found")
+            return
+        if model["pipeline"] not in SUPPORTED_PIPELINES:
+            self._fail_jobs(batch, f"Pipeline '{model['pipeline']}' can't generate images from text")
+            return
+        started_at = time.monotonic()
+        for job in batch:
+            self._metric_queue_seconds.observe(started_at - job["submitted_at"], model["id"])
+            for waiting_job in self._get_waiting_jobs(job):
+                self._results_map.set(waiting_job["id"], {
+                    "status": "PROCESSING"
+                })
+                if self._journal is not None:
+                    self._journal.set_status(waiting_job["id"], "PROCESSING")
+        entry = self._get_pipeline(model, worker)
+        # Loading the model can take a while, and jobs may have been cancelled
+        # or have expired in the meantime.
+        batch = self._drop_stopped_jobs(batch)
+        if not batch:
+            return
+        pipe = entry.pipe
+        tier = get_speed_tier(model, job_data.get("speed_tier", "balanced"))
+        apply_speed_tier(entry, tier)
+        steps = min(job_data["steps"], tier["max_steps"])
+        num_images = job_data.get("num_images", 1)
+        # A job's images use consecutive seeds from its own, so any one of
+        # them can be generated again on its own.
+        seeds = []
+        for job in batch:
+            seed = job["data"]["seed"] if job["data"].get("seed") is not None else random.randrange(2 ** 32)
+            seeds.append([(seed + offset) % 2 ** 32 for offset in range(num_images)])
+        step_timing = {}
+        stopped = set()
+        start_time = time.time()
+        # Seeded CPU generators give the same image for the same seed whatever
+        # device or batch the job ends up in. The pipeline repeats each
+        # prompt's embeddings num_images times in a row, so the generators
+        # and the output images follow the same job by job order.
+        images = pipe(
+            **build_embedding_kwargs(
+                pipe,
+                [entry.embeddings.get(pipe, job["data"]["prompt"]) for job in batch],
+                [entry.embeddings.get(pipe, job["data"]["negative_prompt"], is_negative=True) for job in batch]
+            ),
+            width=job_data["width"],
+            height=job_data["height"],
+            num_inference_steps=steps,
+            guidance_scale=job_data["cfg_scale"],
+            num_images_per_prompt=num_images,
+            generator=[
+                torch.Generator(device="cpu").manual_seed(seed) for job_seeds in seeds for seed in job_seeds
+            ],
+            callback_on_step_end=self._make_step_callback(
+                batch,
+                steps,
+                num_images,
+                uses_pooled_embeddings(pipe),
+                step_timing,
+                stopped
+            ),
+            callback_on_step_end_tensor_inputs=["latents"]
+        ).images
+        end_time = time.time()
+        elapsed_time = f"{(end_time - start_time):.2f}s"
+        self._record_timing(model["id"], (end_time - start_time) / len(images))
+        self._admission.record(sum(job["work"] for job in batch), end_time - start_time)
+        # Everything after the last denoising step is the VAE decode and the
+        # pipeline's own post-processing.
+        denoised_at = step_timing.get("last_step_at", end_time)
+        self._metric_denoise_seconds.observe(denoised_at - start_time, model["id"])
+        self._metric_decode_seconds.observe(end_time - denoised_at, model["id"])
+        fields = {
+            "elapsed_time": elapsed_time,
+            "speed_tier": job_data.get("speed_tier", "balanced"),
+            "steps": steps
+        }
+        self._postprocess_slots.acquire()
+        with self._idle_condition:
+            self._postprocessing_batches.append(batch)
+        try:
+            self._postprocess_pool.submit(
+                self._finish_batch, worker, model, batch, images, seeds, stopped, fields, time.perf_counter()
+            )
+        except RuntimeError:
+            # The pool has been shut down.
+            self._remove_postprocessing_batch(batch)
+            self._postprocess_slots.release()
+            raise
+
+    def _finish_batch(self, worker: InferenceWorker, model: dict, batch: list, images: list, seeds: list,
+                      stopped: set, fields: dict, handed_off_at: float):
+        """
+        Screens, encodes and stores the images of a batch that has finished
+        denoising. Runs on the post-processing pool, so the worker is already
+        busy with its next batch. If anything raises, every job in the batch
+        that has not finished yet is marked as failed.
+
+        Args:
+            worker: The worker that ran the batch, whose NSFW screener is used.
+            model: The configuration entry of the batch's model.
+            batch: The jobs in the batch.
+            images: The decoded images, grouped job by job.
+            seeds: The seeds of each job's images.
+            stopped: The IDs of jobs that were stopped during the batch.
+            fields: The result fields shared by every job in the batch.
+            handed_off_at: When the worker handed the batch over, from
+                time.perf_counter().
+        """
+        # pylint: disable=W0718
+        try:
+            num_images = len(images) // len(batch)
+            verdicts = [None] * len(images)
+            if worker.nsfw_screener is not None:
+                screen_start = time.perf_counter()
+                verdicts = worker.nsfw_screener.screen(images)
+                self._metric_nsfw_screen_seconds.observe(time.perf_counter() - screen_start, model["id"])
+            for index, (job, job_seeds) in enumerate(zip(batch, seeds)):
+                if job["id"] in stopped:
+                    continue
+                start = index * num_images
+                self._store_job_result(
+                    job,
+                    model,
+                    images[start:start + num_images],
+                    job_seeds,
+                    verdicts[start:start + num_images],
+                    fields
+                )
+        except Exception as e:
+            self._fail_unfinished_jobs(batch)
+            LOGGER.error(f"Post-processing a batch from {worker.device} failed: {e}")
+        finally:
+            self._remove_postprocessing_batch(batch)
+            self._postprocess_slots.release()
+            self._metric_postprocess_seconds.observe(time.perf_counter() - handed_off_at, model["id"])
+
+    def _store_job_result(self, job: dict, model: dict, images: list, seeds: list[int], verdicts: list,
+                          fields: dict):
+        """
+        Applies the NSFW action to a finished job's images, encodes them and
+        stores them as the result of the job and of every job attached to
+        it. Blocked images are left out, and a job whose images were all
+        blocked fails. A job cancelled or expired while its batch waited for
+        post-processing is stopped instead.
+
+        Args:
+            job: The finished job.
+            model: The configuration entry of the job's model.
+            images: The job's generated images.
+            seeds: The seed of each image.
+            verdicts: The NSFW verdict of each image, or None for each image
+                if screening is off.
+            fields: The result fields shared by every job in the batch.
+        """
+        encoded_images = []
+        kept_seeds = []
+        kept_verdicts = []
+        mime_type = None
+        for image, seed, verdict in zip(images, seeds, verdicts):
+            if verdict is not None and verdict["flagged"]:
+                action = "allow" if model["is_nsfw"] else self._nsfw_action
+                self._metric_images_flagged.inc(model["id"], action)
+                if action == "block":
+                    continue
+                if action == "blur":
+                    image = blur_image(image)
+                verdict = dict(verdict, action=action)
+            encode_start = time.perf_counter()
+            encoded_image, mime_type = encode_image(image, "png")
+            self._metric_encode_seconds.observe(time.perf_counter() - encode_start, model["id"])
+            encoded_images.append(encoded_image)
+            kept_seeds.append(seed)
+            kept_verdicts.append(verdict)
+        if not encoded_images:
+            self._fail_jobs([job], "The generated image was flagged as NSFW and has been blocked.")
+            return
+        reason = self._get_stop_reason(job)
+        if reason is not None:
+            self._stop_jobs([job], reason)
+            return
+        record = dict(fields, seed=kept_seeds[0], seeds=kept_seeds)
+        if kept_verdicts[0] is not None:
+            record["nsfw"] = kept_verdicts
+        attached_jobs = []
+        if job.get("cache_key") is not None:
+            # Storing the result releases the claim, so no job can be attached
+            # after the attached jobs are taken here.
+            with self._attached_lock:
+                self._result_cache.put(job["cache_key"], job["id"], model["id"], encoded_images, mime_type, record)
+                attached_jobs = self._attached_jobs.pop(job["id"], [])
+        for finished_job in [job] + attached_jobs:
+            reason = self._get_own_stop_reason(finished_job)
+            if reason is not None:
+                self._stop_jobs([finished_job], reason)
+                continue
+            self._results_map.complete(finished_job["id"], encoded_images, mime_type, record)
+            if self._journal is not None:
+                self._journal.set_status(finished_job["id"], "COMPLETED", self._get_journal_record(finished_job["id"]))
+            self._metric_jobs_completed.inc(model["id"])
+            self._metric_end_to_end_seconds.observe(time.monotonic() - finished_job["submitted_at"], model["id"])
+        self._cancelled_jobs.discard(job["id"])
+
+    def _remove_postprocessing_batch(self, batch: list):
+        with self._idle_condition:
+            self._postprocessing_batches = [
+                pending for pending in self._postprocessing_batches if pending is not batch
+            ]
+
+    def _make_step_callback(self, batch: list, total_steps: int, images_per_job: int, is_xl: bool,
+                            step_timing: dict, stopped: set) -> Callable:
+        """
+        Builds the pipeline step callback that records each job's progress
+        and, every preview interval, a cheap preview of its latents. Jobs that
+        have been cancelled or have passed their deadline are stopped, and
+        once no job in the batch is left the pipeline call is abandoned.
+
+        Args:
+            batch: The jobs in the pipeline call.
+            total_steps: The number of denoising steps in the call.
+            images_per_job: The number of images each job generates. Jobs
+                with several images get a preview of their first one.
+            is_xl: Whether the pipeline is an SDXL pipeline.
+            step_timing: A dictionary the callback stores the time of the
+                latest finished step in, under "last_step_at".
+            stopped: A set the callback adds the IDs of stopped jobs to.
+
+        Returns:
+            A callable for the pipeline's callback_on_step_end argument.
+
+        Raises:
+            BatchStopped: From the callback, once every job has been stopped.
+        """
+        def on_step_end(_pipe, step: int, _timestep, callback_kwargs: dict) -> dict:
+            for job in batch:
+                if job["id"] not in stopped:
+                    reason = self._get_stop_reason(job)
+                    if reason is not None:
+                        stopped.add(job["id"])
+                        self._stop_jobs([job], reason)
+            if len(stopped) == len(batch):
+                raise BatchStopped()
+            completed_steps = step + 1
+            previews = None
+            if (self._preview_interval > 0
+                    and completed_steps % self._preview_interval == 0
+                    and completed_steps < total_steps):
+                previews = latents_to_previews(callback_kwargs["latents"], is_xl)
+            for index, job in enumerate(batch):
+                if job["id"] in stopped:
+                    continue
+                fields = {
+                    "progress": {
+                        "step": completed_steps,
+                        "total_steps": total_steps
+                    }
+                }
+                if previews is not None:
+                    fields["preview"] = previews[index * images_per_job]
+                for waiting_job in self._get_waiting_jobs(job):
+                    self._results_map.update(waiting_job["id"], fields)
+            step_timing["last_step_at"] = time.time()
+            return callback_kwargs
+        return on_step_end
+
+    def _select_worker(self, model_id: str) -> InferenceWorker:
+        """
+        Picks an idle worker for a model, preferring one that already has the
+        model's pipeline loaded. Must be called with the idle condition held.
+
+        Args:
+            model_id: The ID of the model the batch needs.
+
+        Returns:
+            The selected worker, marked as busy.
+        """
+        idle_workers = [worker for worker in self._workers if not worker.busy]
+        selected = idle_workers[0]
+        for worker in idle_workers:
+            if worker.pipeline_cache.contains(model_id):
+                selected = worker
+                break
+        selected.busy = True
+        return selected
+
+    def _dispatch_jobs(self):
+        """
+        Continuously hands batches of jobs to idle workers until a stop event
+        is set. A batch is only formed once a worker is free, so jobs keep
+        accumulating in the queue while every worker is busy.
         """
         while not self._stop_event.is_set():
-            # pylint: disable=W0718
+            if self._journal is not None and time.monotonic() - self._last_journal_purge > JOURNAL_PURGE_INTERVAL:
+                self._journal.purge_expired(self._results_map.ttl)
+                self._last_journal_purge = time.monotonic()
+            with self._idle_condition:
+                while all(worker.busy for worker in self._workers) and not self._stop_event.is_set():
+                    self._idle_condition.wait(timeout=1)
+            if self._stop_event.is_set():
+                break
             try:
-                job = self._job_queue.get(block=True, timeout=1)
-                try:
-                    diffusers.utils.logging.set_verbosity_error()
-                    diffusers.utils.logging.enable_default_handler()
-                    diffusers.utils.logging.enable_explicit_format()
-                    job_data = job["data"]
-                    model = self._get_model_from_config(job_data["model"])
-                    if not hasattr(diffusers, model["pipeline"]):
-                        self._results_map[job["id"]] = {
-                            "status": "FAILED",
-                            "error": f"Pipeline '{model['pipeline']}' not found"
-                        }
-                        self._job_queue.task_done()
-                        continue
-                    self._results_map[job["id"]] = {
-                        "status": "PROCESSING"
-                    }
-                    pipe_class = getattr(diffusers, model["pipeline"])
-                    if self._auth_token is not None:
-                        pipe = pipe_class.from_single_file(
-                            model["path"],
-                            torch_dtype=torch.float16,
-                            token=self._auth_token,
-                            use_safetensors=True
-                        )
-                    else:
-                        pipe = pipe_class.from_single_file(
-                            model["path"],
-                            torch_dtype=torch.float16,
-                            use_safetensors=True
-                        )
-                    pipe.enable_model_cpu_offload()
-                    tokenizer = pipe.tokenizer
-                    prompt_tokens = tokenizer(
-                        job_data["prompt"],
-                        return_tensors="pt"
-                    )
-                    negative_prompt_tokens = tokenizer(
-                        job_data["negative_prompt"],
-                        return_tensors="pt"
-                    )
-                    num_prompt_tokens = len(prompt_tokens["input_ids"][0])
-                    num_negative_prompt_tokens = len(negative_prompt_tokens["input_ids"][0])
-                    del prompt_tokens
-                    del negative_prompt_tokens
-                    del tokenizer
-                    helper = DeepCacheSDHelper(
-                        pipe=pipe
-                    )
-                    helper.set_params(
-                        cache_interval=3,
-                        cache_branch_id=0
-                    )
-                    helper.enable()
-                    if num_prompt_tokens > 75:
-                        self._results_map[job["id"]] = {
-                            "status": "FAILED",
-                            "error": "Prompt is too long"
-                        }
-                        continue
-                    if num_negative_prompt_tokens > 75:
-                        self._results_map[job["id"]] = {
-                            "status": "FAILED",
-                            "error": "Negative Prompt is too long"
-                        }
-                        continue
-                    start_time = time.time()
-                    image = pipe(
-                        job_data["prompt"],
-                        negative_prompt=job_data["negative_prompt"] if job_data["negative_prompt"] != "" else None,
-                        width=job_data["width"],
-                        height=job_data["height"],
-                        num_inference_steps=job_data["steps"],
-                        guidance_scale=job_data["cfg_scale"]
-                    ).images[0]
-                    end_time = time.time()
-                    elapsed_time = f"{(end_time - start_time):.2f}s"
-                    image_stream = io.BytesIO()
-                    image.save(image_stream, format="PNG")
-                    encoded_image = base64.b64encode(image_stream.getvalue()).decode("UTF-8")
-                    encoded_image = f"data:image/png;base64,{encoded_image}"
-                    self._results_map[job["id"]] = {
-                        "status": "COMPLETED",
-                        "image": encoded_image,
-                        "elapsed_time": elapsed_time
-                    }
-                except Exception as e:
-                    self._results_map[job["id"]] = {
-                        "status": "FAILED",
-                        "error": "An exception was thrown."
-                    }
-                    print(e)
-                finally:
-                    if "pipe" in locals() or "pipe" in globals():
-                        del pipe
-                    if "helper" in locals() or "helper" in globals():
-                        del helper
-                    torch.cuda.empty_cache()
-                    gc.collect()
-                    self._job_queue.task_done()
+                batch = self._next_batch()
             except queue.Empty:
-                pass
+                continue
+            if not batch:
+                continue
+            with self._idle_condition:
+                worker = self._select_worker(batch[0]["data"]["model"])
+                worker.current_batch = batch
+            worker.assign(batch)
+            # Every job still waiting has moved up the queue.
+            self._job_events.publish_all("PENDING")
+
+    def _process_batch(self, worker: InferenceWorker, batch: list):
+        """
+        Processes a batch of jobs on a worker's thread. Results, including
+        success status and the encoded images, are stored in the results map
+        by the post-processing pool. If the batch raises, every job that has
+        not already finished is marked as failed. The worker is marked as idle
+        again as soon as its pipeline call is done.
+
+        Args:
+            worker: The worker running the batch.
+            batch: The batch of compatible jobs to process.
+        """
+        # pylint: disable=W0718
+        try:
+            self._run_batch(worker, batch)
+        except BatchStopped:
+            LOGGER.info(f"Stopped a batch of {len(batch)} cancelled or expired jobs on {worker.device}.")
+        except Exception as e:
+            self._fail_unfinished_jobs(batch)
+            LOGGER.error(f"Batch on {worker.device} failed: {e}")
+        finally:
+            with self._idle_condition:
+                worker.busy = False
+                worker.current_batch = None
+                self._idle_condition.notify_all()
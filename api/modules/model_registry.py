@@ -0,0 +1,107 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional
+from modules import general
+
+# Only changes to these fields need a model's loaded pipelines to be thrown
+# away, anything else is read afresh for every job.
+PIPELINE_FIELDS = ("path", "pipeline")
+
+class ModelCatalog:
+    """
+    An immutable snapshot of config.json. The registry swaps whole catalogs,
+    so a reader holding one always sees a consistent set of models.
+    """
+    def __init__(self, models: list[dict]):
+        self.models = models
+        self.index = {model["id"]: model for model in models}
+        encoded = json.dumps(models, sort_keys=True).encode("UTF-8")
+        self.etag = hashlib.sha256(encoded).hexdigest()[:32]
+
+class ModelRegistry:
+    def __init__(self, path: str = "config.json", check_interval: float = 2.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._file_stat = self._stat()
+        self._catalog = ModelCatalog(general.get_config(path))
+        self._last_check = time.monotonic()
+        self._reload_lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, listener: Callable[[list[str]], None]):
+        """
+        Registers a callable that is given the IDs of models that were removed
+        or whose checkpoint changed, each time the catalog is reloaded.
+
+        Args:
+            listener: The callable to notify.
+        """
+        self._listeners.append(listener)
+
+    def get(self, model_id: str) -> Optional[dict]:
+        return self._get_catalog().index.get(model_id)
+
+    def list(self) -> list[dict]:
+        return self._get_catalog().models
+
+    @property
+    def etag(self) -> str:
+        return self._get_catalog().etag
+
+    def reload(self) -> bool:
+        """
+        Reads config.json again and atomically swaps in the new catalog if it
+        differs from the current one. If the file cannot be read, the current
+        catalog is kept.
+
+        Returns:
+            True if the catalog changed.
+
+        Raises:
+            OSError: If the file cannot be read.
+            ValueError: If the file is not valid JSON.
+        """
+        with self._reload_lock:
+            self._last_check = time.monotonic()
+            file_stat = self._stat()
+            previous = self._catalog
+            catalog = ModelCatalog(general.get_config(self.path))
+            self._file_stat = file_stat
+            if catalog.etag == previous.etag:
+                return False
+            self._catalog = catalog
+        stale_ids = [
+            model_id for model_id, model in previous.index.items()
+            if model_id not in catalog.index
+            or any(model.get(field) != catalog.index[model_id].get(field) for field in PIPELINE_FIELDS)
+        ]
+        for listener in self._listeners:
+            listener(stale_ids)
+        return True
+
+    def _get_catalog(self) -> ModelCatalog:
+        # Checking the file's size and modification time costs a single stat
+        # call, and is done at most once per check interval.
+        if time.monotonic() - self._last_check > self.check_interval:
+            self._last_check = time.monotonic()
+            if self._stat() != self._file_stat:
+                try:
+                    self.reload()
+                except (OSError, ValueError):
+                    # The file may be half written, the next check will try again.
+                    pass
+        return self._catalog
+
+    def _stat(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
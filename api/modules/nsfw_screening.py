@@ -0,0 +1,60 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+# The NudeNet labels that flag an image, one per line. The bot reads the same
+# file for its own checks.
+DEFAULT_LABELS_PATH = "nsfw_labels.txt"
+TOP_LABELS = 3
+# The blur radius as a fraction of the image's longest side.
+BLUR_RADIUS_FRACTION = 0.04
+
+def read_labels(path: str = DEFAULT_LABELS_PATH) -> list[str]:
+    with open(path, "r", encoding="UTF-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+class NsfwScreener:
+    def __init__(self, model_path: str, threshold: float, labels: list[str], inference_resolution: int = 640):
+        # pylint: disable=C0415
+        # Screening is optional, so NudeNet and its ONNX Runtime and OpenCV
+        # dependencies are only needed once a screener is created.
+        from nudenet import NudeDetector
+        self._detector = NudeDetector(model_path=model_path, inference_resolution=inference_resolution)
+        self.threshold = threshold
+        self.labels = set(labels)
+
+    def screen(self, images: list[Image.Image]) -> list[dict]:
+        """
+        Runs the NudeNet detector over a batch of images in one call.
+
+        Args:
+            images: The generated images.
+
+        Returns:
+            One verdict per image, with whether it was "flagged" and its top
+            detected "labels" with their scores.
+        """
+        # NudeNet expects arrays in OpenCV's BGR channel order.
+        arrays = [np.ascontiguousarray(np.asarray(image.convert("RGB"))[:, :, ::-1]) for image in images]
+        results = self._detector.detect_batch(arrays, batch_size=len(arrays))
+        return [self._get_verdict(detections) for detections in results]
+
+    def _get_verdict(self, detections: list[dict]) -> dict:
+        flagged = any(
+            detection["class"] in self.labels and detection["score"] >= self.threshold
+            for detection in detections
+        )
+        top_detections = sorted(detections, key=lambda detection: detection["score"], reverse=True)[:TOP_LABELS]
+        return {
+            "flagged": flagged,
+            "labels": [
+                {"label": detection["class"], "score": round(float(detection["score"]), 3)}
+                for detection in top_detections
+            ]
+        }
+
+def blur_image(image: Image.Image) -> Image.Image:
+    return image.filter(ImageFilter.GaussianBlur(max(image.size) * BLUR_RADIUS_FRACTION))
@@ -0,0 +1,164 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import gc
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+import torch
+from modules.embedding_cache import EmbeddingCache
+
+class CachedPipeline:
+    def __init__(self, model_id: str, pipe: Any, helper: Any, size_bytes: int, embeddings: EmbeddingCache):
+        self.model_id = model_id
+        self.pipe = pipe
+        self.helper = helper
+        self.size_bytes = size_bytes
+        self.embeddings = embeddings
+        self.schedulers = {}
+        self.cache_interval = None
+
+def estimate_pipeline_size(pipe: Any) -> int:
+    """
+    Estimates the memory held by a pipeline by summing the size of every
+    parameter and buffer in its torch modules.
+
+    Args:
+        pipe: The diffusers pipeline to measure.
+
+    Returns:
+        The estimated size of the pipeline in bytes.
+    """
+    total = 0
+    for component in pipe.components.values():
+        if not isinstance(component, torch.nn.Module):
+            continue
+        for tensor in list(component.parameters()) + list(component.buffers()):
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+class PipelineCache:
+    def __init__(self, max_entries: int, max_bytes: int, max_embeddings: int = 256):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_embeddings = max_embeddings
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, model_id: str, loader: Callable[[], tuple],
+            on_load: Optional[Callable[[CachedPipeline], None]] = None,
+            expected_bytes: Optional[int] = None) -> CachedPipeline:
+        """
+        Returns the cached pipeline for a model, loading it with the given
+        loader on a miss. Least recently used pipelines are evicted until the
+        new pipeline fits within the entry and memory budgets. If the size of
+        the pipeline is known up front, room is made before loading it, so
+        the evicted pipelines and the new one are never in memory together.
+
+        Args:
+            model_id: The ID of the model the pipeline belongs to.
+            loader: A callable returning a (pipe, helper) tuple for the model.
+            on_load: An optional callable run on a freshly loaded entry before
+                it is cached, for example to pre-encode common prompts.
+            expected_bytes: The expected size of the pipeline, if known.
+
+        Returns:
+            The CachedPipeline entry for the model.
+        """
+        with self._lock:
+            entry = self._entries.get(model_id)
+            if entry is not None:
+                self._entries.move_to_end(model_id)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            if expected_bytes is not None:
+                self._make_room(expected_bytes)
+        pipe, helper = loader()
+        entry = CachedPipeline(
+            model_id,
+            pipe,
+            helper,
+            estimate_pipeline_size(pipe),
+            EmbeddingCache(self.max_embeddings)
+        )
+        if on_load is not None:
+            on_load(entry)
+        with self._lock:
+            self._make_room(entry.size_bytes)
+            self._entries[model_id] = entry
+        return entry
+
+    def contains(self, model_id: str) -> bool:
+        with self._lock:
+            return model_id in self._entries
+
+    def evict(self, model_id: str) -> bool:
+        """
+        Removes a single model's pipeline from the cache, if present.
+
+        Args:
+            model_id: The ID of the model to evict.
+
+        Returns:
+            True if a pipeline was evicted, otherwise False.
+        """
+        with self._lock:
+            entry = self._entries.pop(model_id, None)
+            if entry is None:
+                return False
+            self.evictions += 1
+        self._release(entry)
+        return True
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            self._release(entry)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": list(self._entries.keys()),
+                "size_bytes": sum(entry.size_bytes for entry in self._entries.values()),
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "embeddings": {
+                    model_id: entry.embeddings.get_stats() for model_id, entry in self._entries.items()
+                }
+            }
+
+    def _make_room(self, incoming_bytes: int):
+        # A pipeline larger than the whole budget is still cached on its own,
+        # otherwise every job for that model would reload it from disk.
+        used_bytes = sum(entry.size_bytes for entry in self._entries.values())
+        while self._entries and (
+                len(self._entries) >= self.max_entries
+                or used_bytes + incoming_bytes > self.max_bytes
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            used_bytes -= evicted.size_bytes
+            self.evictions += 1
+            self._release(evicted)
+
+    @staticmethod
+    def _release(entry: Optional[CachedPipeline]):
+        if entry is None:
+            return
+        if entry.helper is not None and entry.cache_interval is not None:
+            entry.helper.disable()
+        entry.pipe = None
+        entry.helper = None
+        entry.embeddings = None
+        entry.schedulers = {}
+        gc.collect()
+        torch.cuda.empty_cache()
@@ -0,0 +1,53 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+from typing import Any, Optional
+import diffusers
+import torch
+from DeepCache import DeepCacheSDHelper
+from modules.checkpoint_cache import load_converted_pipeline
+
+def load_pipeline(model: dict, device: str, torch_dtype: torch.dtype, auth_token: Optional[str] = None,
+                  cache_dir: Optional[str] = None) -> tuple[Any, Any]:
+    """
+    Loads a model's pipeline onto a device and creates a DeepCache helper for
+    it. The helper is left disabled, speed tiers enable it with their own
+    cache interval. When a conversion cache directory is given, the single
+    file checkpoint is converted to the diffusers format once and loaded from
+    there afterwards.
+
+    Args:
+        model: The configuration entry of the model to load.
+        device: The device to place the pipeline on, e.g. "cuda:0" or "cpu".
+        torch_dtype: The dtype to load the weights in.
+        auth_token: An optional HuggingFace token for fetching configs.
+        cache_dir: An optional checkpoint conversion cache directory.
+
+    Returns:
+        A tuple containing the loaded pipeline and its DeepCache helper.
+    """
+    pipe_class = getattr(diffusers, model["pipeline"])
+    if cache_dir is not None:
+        pipe = load_converted_pipeline(model, cache_dir, torch_dtype, auth_token)
+    elif auth_token is not None:
+        pipe = pipe_class.from_single_file(
+            model["path"],
+            torch_dtype=torch_dtype,
+            token=auth_token,
+            use_safetensors=True
+        )
+    else:
+        pipe = pipe_class.from_single_file(
+            model["path"],
+            torch_dtype=torch_dtype,
+            use_safetensors=True
+        )
+    if device.startswith("cuda"):
+        pipe.enable_model_cpu_offload(gpu_id=int(device.split(":")[1]) if ":" in device else 0)
+    else:
+        pipe.to(device)
+    helper = DeepCacheSDHelper(
+        pipe=pipe
+    )
+    return pipe, helper
@@ -0,0 +1,53 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import base64
+import torch
+from PIL import Image
+from modules.image_encoding import encode_image
+
+# Linear approximations of the VAE decoder, mapping the four latent channels
+# straight to RGB. They are far too rough for a final image, but cost next to
+# nothing compared to a full VAE decode.
+SD_LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177]
+]
+SD_LATENT_RGB_BIAS = [0.0, 0.0, 0.0]
+SDXL_LATENT_RGB_FACTORS = [
+    [0.3651, 0.4232, 0.4341],
+    [-0.2533, -0.0042, 0.1068],
+    [0.1076, 0.1111, -0.0362],
+    [-0.3165, -0.2492, -0.2188]
+]
+SDXL_LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
+
+def latents_to_previews(latents: torch.Tensor, is_xl: bool, quality: int = 60) -> list[str]:
+    """
+    Turns a batch of latents into small preview images using a linear
+    latent-to-RGB approximation. Previews are at latent resolution, an eighth
+    of the final image's width and height.
+
+    Args:
+        latents: The latents of the batch, shaped (batch, 4, height, width).
+        is_xl: Whether the latents come from an SDXL pipeline.
+        quality: The WebP quality of the encoded previews.
+
+    Returns:
+        One base64 WebP data URL per image in the batch.
+    """
+    factors = SDXL_LATENT_RGB_FACTORS if is_xl else SD_LATENT_RGB_FACTORS
+    bias = SDXL_LATENT_RGB_BIAS if is_xl else SD_LATENT_RGB_BIAS
+    with torch.no_grad():
+        factors = torch.tensor(factors, dtype=torch.float32)
+        bias = torch.tensor(bias, dtype=torch.float32)
+        rgb = torch.einsum("bchw,cr->bhwr", latents.detach().float().cpu(), factors) + bias
+        rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8).numpy()
+    previews = []
+    for pixels in rgb:
+        encoded, mime_type = encode_image(Image.fromarray(pixels), "webp", quality)
+        previews.append(f"data:{mime_type};base64,{base64.b64encode(encoded).decode('UTF-8')}")
+    return previews
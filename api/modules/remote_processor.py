@@ -0,0 +1,233 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import asyncio
+import base64
+import json
+import socket
+import threading
+from typing import AsyncIterator, Optional
+from modules.image_encoding import IMAGE_FORMATS, get_variant_key, transcode_image
+from modules.inference_service import WATCH_METHOD, decode_message, encode_message
+
+STREAM_LINE_LIMIT = 4 * 1024 ** 2
+
+class InferenceServiceUnavailable(Exception):
+    """
+    Raised when the inference service cannot be reached, for example while
+    it is being restarted.
+    """
+
+class RemoteJobProcessor:
+    """
+    Stands in for a DiffusionJobProcessor inside an HTTP frontend, forwarding
+    every call to the inference service over its Unix socket. It keeps no job
+    state of its own, so any number of frontend processes can share one
+    service.
+    """
+    def __init__(self, socket_path: str, timeout: float = 30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def start_processing(self):
+        pass
+
+    def stop_processing(self):
+        self._disconnect()
+
+    def is_ready(self) -> bool:
+        try:
+            return self._call("is_ready")
+        except InferenceServiceUnavailable:
+            return False
+
+    def render_metrics(self) -> str:
+        return self._call("render_metrics")
+
+    def get_cache_stats(self) -> dict:
+        return self._call("get_cache_stats")
+
+    def validate_job(self, job_data: dict) -> Optional[str]:
+        return self._call("validate_job", job_data)
+
+    def get_retry_after(self, job_data: dict) -> Optional[int]:
+        return self._call("get_retry_after", job_data)
+
+    def add_job(self, job_data: dict) -> str:
+        return self._call("add_job", job_data)
+
+    def cancel_job(self, job_id: str) -> Optional[bool]:
+        return self._call("cancel_job", job_id)
+
+    def get_result(self, job_id: str, include_image: bool = True) -> dict:
+        """
+        Fetches a job's result from the inference service without its images,
+        then embeds the images as data URLs from the shared results
+        directory, so they are never copied over the socket.
+
+        Args:
+            job_id: The unique ID of the job to retrieve the result for.
+            include_image: Whether to embed the images as base64 data URLs.
+
+        Returns:
+            The result dictionary, in the same shape as
+            DiffusionJobProcessor.get_result.
+        """
+        result = self._call("get_result", job_id, False)
+        if result.get("status") != "COMPLETED" or not include_image:
+            return result
+        result["images"] = []
+        for index in range(result["num_images"]):
+            image = self._read_image(job_id, index)
+            if image is None:
+                return {
+                    "status": "FAILED",
+                    "error": "The result of this job is no longer available."
+                }
+            encoded_image = base64.b64encode(image[0]).decode("UTF-8")
+            result["images"].append(f"data:{image[1]};base64,{encoded_image}")
+        result["image"] = result["images"][0]
+        return result
+
+    def get_queue_info(self) -> dict:
+        return self._call("get_queue_info")
+
+    def reload_models(self) -> dict:
+        return self._call("reload_models")
+
+    def get_image(self, job_id: str, image_format: str, quality: int, lossless: bool,
+                  index: int = 0) -> Optional[tuple[bytes, str]]:
+        """
+        Reads one of the images of a completed job straight from the shared
+        results directory, transcoding it in this process if another format
+        was asked for, so encoding work is spread over the frontends.
+
+        Args:
+            job_id: The unique ID of the job to retrieve the image for.
+            image_format: The output format, one of "png", "webp" or "jpeg".
+            quality: The encoder quality for lossy output, from 1 to 100.
+            lossless: Whether WebP output should be lossless.
+            index: The position of the image among the job's images.
+
+        Returns:
+            A tuple containing the encoded bytes and their MIME type, or None
+            if the job has no such image.
+        """
+        image = self._read_image(job_id, index)
+        if image is None:
+            return None
+        image, stored_mime_type = image
+        variant_key = get_variant_key(image_format, quality, lossless)
+        if stored_mime_type == IMAGE_FORMATS[image_format][1] and variant_key == image_format:
+            return image, stored_mime_type
+        return transcode_image(image, image_format, quality, lossless)
+
+    def _read_image(self, job_id: str, index: int) -> Optional[tuple[bytes, str]]:
+        location = self._call("get_image_location", job_id, index)
+        if location is None:
+            return None
+        try:
+            with open(location["image_path"], "rb") as f:
+                return f.read(), location["mime_type"]
+        except FileNotFoundError:
+            return None
+
+    async def open_result_stream(self, job_id: str) -> AsyncIterator[str]:
+        """
+        Connects to the inference service to watch a job, before any of the
+        response is sent, so an unreachable service can still be reported
+        with a 503.
+
+        Args:
+            job_id: The unique ID of the job to stream.
+
+        Returns:
+            An async iterator of Server-Sent Event frames containing the
+            job's result as JSON, relayed over a connection of its own.
+
+        Raises:
+            InferenceServiceUnavailable: If the service cannot be reached.
+        """
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path, limit=STREAM_LINE_LIMIT)
+        except OSError as e:
+            raise InferenceServiceUnavailable(str(e)) from e
+        try:
+            writer.write(encode_message({"method": WATCH_METHOD, "args": [job_id]}))
+            await writer.drain()
+        except OSError as e:
+            writer.close()
+            raise InferenceServiceUnavailable(str(e)) from e
+        return self._relay_result(reader, writer)
+
+    @staticmethod
+    async def _relay_result(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> AsyncIterator[str]:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                message = decode_message(line)
+                if "result" in message:
+                    yield f"data: {json.dumps(message['result'])}\n\n"
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            writer.close()
+
+    def _connect(self) -> tuple:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        try:
+            connection.connect(self.socket_path)
+        except OSError:
+            connection.close()
+            raise
+        return connection, connection.makefile("rb")
+
+    def _disconnect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+            self._local.connection = None
+
+    def _call(self, method: str, *args):
+        """
+        Calls a processor method in the inference service. Each thread keeps
+        its own connection open between calls. A request that fails to send
+        over a reused connection is retried once on a new one, since the
+        service may have restarted since the connection was last used.
+
+        Raises:
+            InferenceServiceUnavailable: If the service cannot be reached or
+                drops the connection before answering.
+            RuntimeError: If the service reports an error.
+        """
+        request = encode_message({"method": method, "args": list(args)})
+        for attempt in range(2):
+            connection = getattr(self._local, "connection", None)
+            try:
+                if connection is None:
+                    connection = self._local.connection = self._connect()
+                connection[0].sendall(request)
+            except OSError as e:
+                self._disconnect()
+                if attempt == 0:
+                    continue
+                raise InferenceServiceUnavailable(str(e)) from e
+            try:
+                line = connection[1].readline()
+            except OSError as e:
+                self._disconnect()
+                raise InferenceServiceUnavailable(str(e)) from e
+            if not line:
+                self._disconnect()
+                raise InferenceServiceUnavailable("The inference service closed the connection.")
+            response = decode_message(line)
+            if "error" in response:
+                raise RuntimeError(response["error"])
+            return response["result"]
+        raise InferenceServiceUnavailable("The inference service could not be reached.")
@@ -2,6 +2,7 @@
 # Licensed under the GNU Affero General Public License v3.0 #
 # ----------------------------------------------------------#
 
+from typing import Literal, Optional
 from pydantic import BaseModel
 
 class InferenceRequest(BaseModel):
@@ -12,3 +13,10 @@ class InferenceRequest(BaseModel):
     height: int
     steps: int
     cfg_scale: float
+    seed: Optional[int] = None
+    num_images: int = 1
+    speed_tier: Literal["fast", "balanced", "quality"] = "balanced"
+    user_id: Optional[int] = None
+    guild_id: Optional[int] = None
+    priority: Literal["high", "normal", "low"] = "normal"
+    deadline: Optional[float] = None
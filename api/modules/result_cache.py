@@ -0,0 +1,177 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+CACHE_KEY_FIELDS = (
+    "model",
+    "prompt",
+    "negative_prompt",
+    "width",
+    "height",
+    "steps",
+    "cfg_scale",
+    "seed",
+    "speed_tier",
+    "num_images"
+)
+
+class CachedResult:
+    def __init__(self, model_id: str, images: list[bytes], mime_type: str, record: dict):
+        self.model_id = model_id
+        self.images = images
+        self.mime_type = mime_type
+        self.record = record
+        self.size_bytes = sum(len(image) for image in images)
+
+def get_cache_key(job_data: dict) -> Optional[str]:
+    """
+    Hashes the fields of a job that decide its output. Only jobs with an
+    explicit seed are deterministic, so jobs without one are never cached.
+
+    Args:
+        job_data: The job's request data.
+
+    Returns:
+        A hex SHA-256 digest of the normalized request, or None if the job
+        cannot be cached.
+    """
+    if job_data.get("seed") is None:
+        return None
+    normalized = {field: job_data.get(field) for field in CACHE_KEY_FIELDS}
+    normalized["prompt"] = " ".join(normalized["prompt"].split())
+    normalized["negative_prompt"] = " ".join(normalized["negative_prompt"].split())
+    normalized["cfg_scale"] = round(float(normalized["cfg_scale"]), 4)
+    encoded = json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode("UTF-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+class ResultCache:
+    def __init__(self, max_bytes: int):
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._size_bytes = 0
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.attached = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, cache_key: str) -> Optional[CachedResult]:
+        with self._lock:
+            result = self._entries.get(cache_key)
+            if result is not None:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+            return result
+
+    def contains(self, cache_key: str) -> bool:
+        """
+        Checks whether a cache key's result is stored or being produced,
+        without counting towards the hit statistics.
+        """
+        with self._lock:
+            return cache_key in self._entries or cache_key in self._in_flight
+
+    def claim(self, cache_key: str, job_id: str, model_id: str) -> Optional[str]:
+        """
+        Registers a job as the one producing a cache key's result, unless
+        another job is already producing it.
+
+        Args:
+            cache_key: The cache key of the job.
+            job_id: The ID of the job about to be queued.
+            model_id: The ID of the job's model.
+
+        Returns:
+            The ID of the job already producing the result, which the caller
+            should attach to instead of queueing, or None if the claim
+            succeeded.
+        """
+        with self._lock:
+            existing = self._in_flight.get(cache_key)
+            if existing is not None:
+                self.attached += 1
+                return existing[0]
+            self._in_flight[cache_key] = (job_id, model_id)
+            self.misses += 1
+            return None
+
+    def release(self, cache_key: str, job_id: str):
+        with self._lock:
+            self._release(cache_key, job_id)
+
+    def _release(self, cache_key: str, job_id: str) -> bool:
+        existing = self._in_flight.get(cache_key)
+        if existing is None or existing[0] != job_id:
+            return False
+        del self._in_flight[cache_key]
+        return True
+
+    def put(self, cache_key: str, job_id: str, model_id: str, images: list[bytes], mime_type: str, record: dict):
+        """
+        Stores a finished result and releases its in-flight claim. Least
+        recently used results are evicted to stay within the byte budget.
+        Results of jobs whose claim was invalidated are not stored.
+
+        Args:
+            cache_key: The cache key of the job.
+            job_id: The ID of the job that produced the result.
+            model_id: The ID of the job's model.
+            images: The encoded bytes of each image.
+            mime_type: The MIME type of the encoded images.
+            record: The extra result fields to return on a hit.
+        """
+        result = CachedResult(model_id, images, mime_type, record)
+        with self._lock:
+            if not self._release(cache_key, job_id):
+                return
+            if result.size_bytes > self.max_bytes:
+                return
+            previous = self._entries.pop(cache_key, None)
+            if previous is not None:
+                self._size_bytes -= previous.size_bytes
+            self._entries[cache_key] = result
+            self._size_bytes += result.size_bytes
+            while self._size_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size_bytes -= evicted.size_bytes
+                self.evictions += 1
+
+    def invalidate_models(self, model_ids: list[str]):
+        """
+        Forgets every result of models that were removed or whose checkpoint
+        changed, since the cache key only holds the model's ID. Jobs still
+        producing results for them keep running, but their results are not
+        cached.
+
+        Args:
+            model_ids: The IDs of the stale models.
+        """
+        model_ids = set(model_ids)
+        with self._lock:
+            for cache_key in [key for key, result in self._entries.items() if result.model_id in model_ids]:
+                self._size_bytes -= self._entries.pop(cache_key).size_bytes
+                self.invalidations += 1
+            for cache_key in [key for key, claim in self._in_flight.items() if claim[1] in model_ids]:
+                del self._in_flight[cache_key]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "attached": self.attached,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "in_flight": len(self._in_flight),
+                "size_bytes": self._size_bytes,
+                "max_bytes": self.max_bytes
+            }
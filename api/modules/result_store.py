@@ -0,0 +1,302 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import base64
+import collections
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+TERMINAL_STATUSES = ("COMPLETED", "FAILED")
+PAYLOAD_EXTENSIONS = (".png", ".webp", ".jpeg")
+
+class ResultStore:
+    def __init__(self, results_dir: str, ttl: float, max_bytes: int, spill_bytes: int,
+                 on_change: Optional[Callable[[str, str], None]] = None, persist: bool = False):
+        self._records = {}
+        self._payloads = collections.OrderedDict()
+        self._variants = {}
+        self._expiry_queue = collections.deque()
+        self._lock = threading.RLock()
+        self._memory_bytes = 0
+        self.results_dir = results_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.spill_bytes = spill_bytes
+        self.on_change = on_change
+        self.persist = persist
+        os.makedirs(self.results_dir, exist_ok=True)
+
+    def __contains__(self, job_id: str) -> bool:
+        with self._lock:
+            self._purge_expired()
+            return job_id in self._records
+
+    def set(self, job_id: str, record: dict):
+        """
+        Replaces the compact record of a job. Records with a terminal status
+        start their TTL countdown from the moment they are stored.
+
+        Args:
+            job_id: The ID of the job.
+            record: The record to store, for example {"status": "PENDING"}.
+        """
+        with self._lock:
+            self._purge_expired()
+            self._drop_payload(job_id)
+            self._store_record(job_id, dict(record))
+        self._notify(job_id, record["status"])
+
+    def update(self, job_id: str, fields: dict):
+        """
+        Merges extra fields, such as progress, into the record of a job that
+        has not finished yet. Finished or unknown jobs are left untouched.
+
+        Args:
+            job_id: The ID of the job.
+            fields: The fields to merge into the record.
+        """
+        with self._lock:
+            record = self._records.get(job_id)
+            if record is None or record["status"] in TERMINAL_STATUSES:
+                return
+            record.update(fields)
+            status = record["status"]
+        self._notify(job_id, status)
+
+    def complete(self, job_id: str, images: list[bytes], mime_type: str, record: dict):
+        """
+        Stores the encoded images of a completed job. Payloads larger than the
+        spill size are written straight to the results directory, and smaller
+        ones are kept in memory until the byte budget forces the oldest of them
+        out to disk. A persistent store writes every payload to disk, keeping
+        small ones in memory as well, so results outlive the process.
+
+        Args:
+            job_id: The ID of the job.
+            images: The encoded bytes of each image, in order.
+            mime_type: The MIME type of the encoded images, e.g. "image/png".
+            record: Any extra fields to keep alongside the images, such as the
+                elapsed time.
+        """
+        record = dict(record, status="COMPLETED", mime_type=mime_type, num_images=len(images))
+        with self._lock:
+            self._purge_expired()
+            self._drop_payload(job_id)
+            # Holds the file each image was written to, or None while it is
+            # only kept in memory.
+            record["image_paths"] = [None] * len(images)
+            for index, image in enumerate(images):
+                if self.persist or len(image) > self.spill_bytes:
+                    record["image_paths"][index] = self._write_payload(job_id, index, mime_type, image)
+                if len(image) <= self.spill_bytes:
+                    self._payloads[(job_id, index)] = image
+                    self._memory_bytes += len(image)
+            self._store_record(job_id, record)
+            self._enforce_budget()
+        self._notify(job_id, "COMPLETED")
+
+    def restore(self, job_id: str, record: dict, age: float):
+        """
+        Puts back the record of a job that finished before a restart, without
+        notifying anyone. Records must be restored oldest first, before any
+        new job finishes, so that they expire in order.
+
+        Args:
+            job_id: The ID of the job.
+            record: The job's terminal record, as it was stored.
+            age: How many seconds ago the job finished.
+        """
+        record = dict(record)
+        record["finished_at"] = time.monotonic() - age
+        with self._lock:
+            self._expiry_queue.append((record["finished_at"], job_id))
+            self._records[job_id] = record
+
+    def remove_orphaned_payloads(self):
+        """
+        Deletes files in the results directory that no stored record refers
+        to, such as the images of jobs that expired while the API was down.
+        """
+        with self._lock:
+            referenced = {
+                image_path
+                for record in self._records.values()
+                for image_path in record.get("image_paths", [])
+                if image_path is not None
+            }
+            for file_name in os.listdir(self.results_dir):
+                path = os.path.join(self.results_dir, file_name)
+                extension = os.path.splitext(file_name)[1]
+                if extension in PAYLOAD_EXTENSIONS and os.path.isfile(path) and path not in referenced:
+                    os.remove(path)
+
+    def get_record(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            self._purge_expired()
+            record = self._records.get(job_id)
+            return dict(record) if record is not None else None
+
+    def get_image(self, job_id: str, index: int = 0) -> Optional[bytes]:
+        """
+        Retrieves the encoded bytes of one of a completed job's images, from
+        memory or from the results directory.
+
+        Args:
+            job_id: The ID of the job.
+            index: The position of the image among the job's images.
+
+        Returns:
+            The encoded image bytes, or None if the job has no such image.
+        """
+        with self._lock:
+            self._purge_expired()
+            payload = self._payloads.get((job_id, index))
+            if payload is not None:
+                return payload
+            record = self._records.get(job_id)
+            image_paths = record.get("image_paths", []) if record is not None else []
+            image_path = image_paths[index] if 0 <= index < len(image_paths) else None
+        if image_path is None:
+            return None
+        try:
+            with open(image_path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get_variant(self, job_id: str, index: int, variant_key: str) -> Optional[tuple[bytes, str]]:
+        with self._lock:
+            return self._variants.get(job_id, {}).get((index, variant_key))
+
+    def put_variant(self, job_id: str, index: int, variant_key: str, data: bytes, mime_type: str):
+        """
+        Caches another encoding of one of a completed job's images, so
+        repeated downloads in the same format are only encoded once. Variants
+        count towards the byte budget and are the first thing dropped when it
+        is exceeded, since they can always be encoded again.
+
+        Args:
+            job_id: The ID of the job.
+            index: The position of the image among the job's images.
+            variant_key: The key describing the encoding, e.g. "webp-80".
+            data: The encoded image bytes.
+            mime_type: The MIME type of the encoded bytes.
+        """
+        with self._lock:
+            if job_id not in self._records:
+                return
+            variants = self._variants.setdefault(job_id, {})
+            previous = variants.get((index, variant_key))
+            if previous is not None:
+                self._memory_bytes -= len(previous[0])
+            variants[(index, variant_key)] = (data, mime_type)
+            self._memory_bytes += len(data)
+            self._enforce_budget()
+
+    def get(self, job_id: str, include_image: bool = True) -> dict:
+        """
+        Builds the client facing result of a job, in the same shape that was
+        returned before results were stored compactly. Completed jobs carry
+        their images as base64 data URLs unless told otherwise, with the first
+        one also under "image".
+
+        Args:
+            job_id: The ID of the job.
+            include_image: Whether to embed the images as data URLs.
+
+        Returns:
+            The result dictionary, or an empty dictionary if the job does not
+            exist or has expired.
+        """
+        record = self.get_record(job_id)
+        if record is None:
+            return {}
+        record.pop("finished_at", None)
+        record.pop("image_paths", None)
+        mime_type = record.pop("mime_type", None)
+        if record["status"] == "COMPLETED" and include_image:
+            record["images"] = []
+            for index in range(record["num_images"]):
+                image = self.get_image(job_id, index)
+                if image is None:
+                    return {
+                        "status": "FAILED",
+                        "error": "The result of this job is no longer available."
+                    }
+                encoded_image = base64.b64encode(image).decode("UTF-8")
+                record["images"].append(f"data:{mime_type};base64,{encoded_image}")
+            record["image"] = record["images"][0]
+        return record
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "records": len(self._records),
+                "memory_payloads": len(self._payloads),
+                "memory_bytes": self._memory_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+    def _notify(self, job_id: str, status: str):
+        if self.on_change is not None:
+            self.on_change(job_id, status)
+
+    def _store_record(self, job_id: str, record: dict):
+        if record["status"] in TERMINAL_STATUSES:
+            record["finished_at"] = time.monotonic()
+            self._expiry_queue.append((record["finished_at"], job_id))
+        self._records[job_id] = record
+
+    def _write_payload(self, job_id: str, index: int, mime_type: str, payload: bytes) -> str:
+        extension = mime_type.split("/")[-1]
+        file_name = f"{job_id}.{extension}" if index == 0 else f"{job_id}-{index}.{extension}"
+        image_path = os.path.join(self.results_dir, file_name)
+        with open(image_path, "wb") as f:
+            f.write(payload)
+        return image_path
+
+    def _enforce_budget(self):
+        while self._memory_bytes > self.max_bytes and self._variants:
+            _, variants = self._variants.popitem()
+            self._memory_bytes -= sum(len(data) for data, _ in variants.values())
+        while self._memory_bytes > self.max_bytes and self._payloads:
+            (spilled_id, index), payload = self._payloads.popitem(last=False)
+            self._memory_bytes -= len(payload)
+            spilled = self._records[spilled_id]
+            if spilled["image_paths"][index] is None:
+                spilled["image_paths"][index] = self._write_payload(spilled_id, index, spilled["mime_type"], payload)
+
+    def _drop_payload(self, job_id: str):
+        record = self._records.get(job_id)
+        if record is None:
+            return
+        image_paths = record.get("image_paths", [])
+        for index in range(len(image_paths)):
+            payload = self._payloads.pop((job_id, index), None)
+            if payload is not None:
+                self._memory_bytes -= len(payload)
+        variants = self._variants.pop(job_id, None)
+        if variants is not None:
+            self._memory_bytes -= sum(len(data) for data, _ in variants.values())
+        for image_path in image_paths:
+            if image_path is None:
+                continue
+            try:
+                os.remove(image_path)
+            except FileNotFoundError:
+                pass
+
+    def _purge_expired(self):
+        # Records are queued in the order they finished, so only the head of
+        # the queue ever needs to be checked.
+        now = time.monotonic()
+        while self._expiry_queue and now - self._expiry_queue[0][0] > self.ttl:
+            finished_at, job_id = self._expiry_queue.popleft()
+            record = self._records.get(job_id)
+            if record is None or record.get("finished_at") != finished_at:
+                continue
+            self._drop_payload(job_id)
+            del self._records[job_id]
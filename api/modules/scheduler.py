@@ -0,0 +1,185 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import collections
+import queue
+import threading
+import time
+from typing import Callable, Hashable, Iterator, Optional
+
+PRIORITIES = ("high", "normal", "low")
+
+class FairScheduler:
+    """
+    A job queue that serves priority classes strictly in order and, within a
+    class, round-robins between submitters so that one submitter with many
+    queued jobs cannot hold everyone else back.
+    """
+    def __init__(self):
+        self._classes = {priority: collections.OrderedDict() for priority in PRIORITIES}
+        self._locations = {}
+        self._condition = threading.Condition()
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._locations)
+
+    def put(self, job: dict, submitter: Hashable, priority: str = "normal"):
+        """
+        Adds a job to the back of its submitter's queue.
+
+        Args:
+            job: The job to add. Must contain an "id" key.
+            submitter: Identifies who sent the job, e.g. a (guild ID, user ID)
+                tuple.
+            priority: The priority class of the job, one of PRIORITIES.
+        """
+        with self._condition:
+            submitters = self._classes[priority]
+            submitters.setdefault(submitter, collections.deque()).append(job)
+            self._locations[job["id"]] = (priority, submitter)
+            self._condition.notify_all()
+
+    def get(self, timeout: float) -> dict:
+        """
+        Removes and returns the next job to run.
+
+        Args:
+            timeout: How long to wait for a job, in seconds.
+
+        Returns:
+            The next job.
+
+        Raises:
+            queue.Empty: If no job arrived within the timeout.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._locations, timeout=timeout):
+                raise queue.Empty
+            for submitters in self._classes.values():
+                if submitters:
+                    submitter, jobs = next(iter(submitters.items()))
+                    job = jobs[0]
+                    self._remove(job, submitter)
+                    return job
+        raise queue.Empty
+
+    def take_matching(self, predicate: Callable[[dict], bool], limit: int, timeout: float) -> list:
+        """
+        Removes up to a limit of jobs matching a predicate, in the order they
+        would otherwise have been served, waiting up to a timeout for more
+        matching jobs to arrive if the limit has not been reached.
+
+        Args:
+            predicate: Returns True for jobs that should be taken.
+            limit: The maximum number of jobs to take.
+            timeout: How long to wait for matching jobs, in seconds.
+
+        Returns:
+            The list of jobs taken, which may be empty.
+        """
+        taken = []
+        wait_until = time.monotonic() + timeout
+        with self._condition:
+            while len(taken) < limit:
+                for job in self._iter_in_order():
+                    if len(taken) >= limit:
+                        break
+                    if predicate(job):
+                        taken.append(job)
+                for job in taken:
+                    if job["id"] in self._locations:
+                        self._remove(job, self._locations[job["id"]][1])
+                remaining = wait_until - time.monotonic()
+                if len(taken) >= limit or remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+        return taken
+
+    def remove(self, job_id: str) -> Optional[dict]:
+        """
+        Removes a queued job without serving it. The job's submitter keeps
+        its place in the rotation.
+
+        Args:
+            job_id: The ID of the job to remove.
+
+        Returns:
+            The removed job, or None if the job is not queued.
+        """
+        with self._condition:
+            location = self._locations.get(job_id)
+            if location is None:
+                return None
+            priority, submitter = location
+            for job in self._classes[priority][submitter]:
+                if job["id"] == job_id:
+                    self._remove(job, submitter, rotate=False)
+                    return job
+        return None
+
+    def get_jobs_until(self, job_id: str) -> Optional[list]:
+        """
+        Lists the jobs that will be served up to and including a queued job.
+
+        Args:
+            job_id: The ID of the queued job.
+
+        Returns:
+            The jobs in serving order, ending with the given job, or None if
+            the job is not queued.
+        """
+        with self._condition:
+            if job_id not in self._locations:
+                return None
+            jobs = []
+            for job in self._iter_in_order():
+                jobs.append(job)
+                if job["id"] == job_id:
+                    return jobs
+        return None
+
+    def get_depths(self) -> dict:
+        with self._condition:
+            return {
+                priority: sum(len(jobs) for jobs in submitters.values())
+                for priority, submitters in self._classes.items()
+            }
+
+    def count_by(self, key: Callable[[dict], Hashable]) -> dict:
+        counts = {}
+        with self._condition:
+            for submitters in self._classes.values():
+                for jobs in submitters.values():
+                    for job in jobs:
+                        job_key = key(job)
+                        counts[job_key] = counts.get(job_key, 0) + 1
+        return counts
+
+    def total(self, value: Callable[[dict], float]) -> float:
+        with self._condition:
+            return sum(value(job) for submitters in self._classes.values()
+                       for jobs in submitters.values() for job in jobs)
+
+    def _iter_in_order(self) -> Iterator[dict]:
+        # Each round takes the next job of every submitter in rotation order,
+        # which is exactly the order repeated calls to get() would follow.
+        for submitters in self._classes.values():
+            rotation = list(submitters.values())
+            longest = max((len(jobs) for jobs in rotation), default=0)
+            for round_index in range(longest):
+                for jobs in rotation:
+                    if round_index < len(jobs):
+                        yield jobs[round_index]
+
+    def _remove(self, job: dict, submitter: Hashable, rotate: bool = True):
+        priority, _ = self._locations.pop(job["id"])
+        submitters = self._classes[priority]
+        jobs = submitters[submitter]
+        jobs.remove(job)
+        if jobs:
+            if rotate:
+                submitters.move_to_end(submitter)
+        else:
+            del submitters[submitter]
@@ -0,0 +1,84 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+from typing import Any
+import diffusers
+
+# A cache interval of 1 recomputes every step, which is the same as running
+# without DeepCache, so the helper is disabled instead. A scheduler of None
+# keeps the scheduler that shipped with the checkpoint. The balanced tier is
+# the default for requests, so it generates exactly as the API did before
+# tiers existed until benchmark_tiers.py shows a better trade-off.
+DEFAULT_SPEED_TIERS = {
+    "fast": {
+        "cache_interval": 5,
+        "scheduler": "DPMSolverMultistepScheduler",
+        "scheduler_options": {"algorithm_type": "dpmsolver++", "use_karras_sigmas": True},
+        "max_steps": 20
+    },
+    "balanced": {
+        "cache_interval": 3,
+        "scheduler": None,
+        "scheduler_options": {},
+        "max_steps": 50
+    },
+    "quality": {
+        "cache_interval": 1,
+        "scheduler": None,
+        "scheduler_options": {},
+        "max_steps": 50
+    }
+}
+SPEED_TIERS = tuple(DEFAULT_SPEED_TIERS.keys())
+
+def get_speed_tier(model: dict, tier_name: str) -> dict:
+    """
+    Resolves a speed tier's settings for a model. A model's config entry can
+    override any setting of any tier under its "speed_tiers" key, e.g.
+    {"speed_tiers": {"fast": {"cache_interval": 4}}}.
+
+    Args:
+        model: The configuration entry of the model.
+        tier_name: The name of the tier, one of SPEED_TIERS.
+
+    Returns:
+        The merged tier settings.
+    """
+    overrides = model.get("speed_tiers", {}).get(tier_name, {})
+    return {**DEFAULT_SPEED_TIERS[tier_name], **overrides}
+
+def apply_speed_tier(entry: Any, tier: dict):
+    """
+    Switches a cached pipeline's scheduler and DeepCache interval to match a
+    speed tier. Nothing is changed if the pipeline is already set up for the
+    same settings.
+
+    Args:
+        entry: The CachedPipeline to configure.
+        tier: The resolved tier settings, from get_speed_tier.
+    """
+    pipe = entry.pipe
+    entry.schedulers.setdefault(None, pipe.scheduler)
+    scheduler_key = (tier["scheduler"], tuple(sorted(tier["scheduler_options"].items())))
+    if tier["scheduler"] is None:
+        scheduler_key = None
+    if scheduler_key not in entry.schedulers:
+        scheduler_class = getattr(diffusers, tier["scheduler"])
+        entry.schedulers[scheduler_key] = scheduler_class.from_config(
+            entry.schedulers[None].config,
+            **tier["scheduler_options"]
+        )
+    pipe.scheduler = entry.schedulers[scheduler_key]
+    cache_interval = tier["cache_interval"] if tier["cache_interval"] > 1 else None
+    if cache_interval == entry.cache_interval:
+        return
+    if entry.cache_interval is not None:
+        entry.helper.disable()
+    if cache_interval is not None:
+        entry.helper.set_params(
+            cache_interval=cache_interval,
+            cache_branch_id=0
+        )
+        entry.helper.enable()
+    entry.cache_interval = cache_interval
@@ -0,0 +1,95 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import threading
+import time
+from typing import Optional
+import diffusers
+from transformers import CLIPTokenizer
+
+# Every Stable Diffusion family model uses the same CLIP BPE vocabulary, so
+# this tokenizer is used unless a model's config entry names another one.
+DEFAULT_TOKENIZER = "openai/clip-vit-large-patch14"
+MAX_PROMPT_TOKENS = 75
+MIN_DIMENSION = 64
+MAX_DIMENSION = 1280
+DIMENSION_MULTIPLE = 8
+MIN_STEPS = 1
+MAX_STEPS = 50
+MAX_SEED = 2 ** 32 - 1
+# The pipeline classes the job processor can run. Jobs only carry prompts, so
+# pipelines that need an input image or mask can't be used.
+SUPPORTED_PIPELINES = ("StableDiffusionPipeline", "StableDiffusionXLPipeline")
+MIN_IMAGES = 1
+# A model's config entry can lower or raise this with "max_images".
+DEFAULT_MAX_IMAGES = 4
+
+class TokenizerCache:
+    def __init__(self, auth_token: Optional[str] = None):
+        self._tokenizers = {}
+        self._lock = threading.Lock()
+        self._auth_token = auth_token
+
+    def get(self, model: dict) -> CLIPTokenizer:
+        """
+        Returns the tokenizer for a model, loading it the first time it is
+        needed. Models sharing a tokenizer share the same loaded instance.
+
+        Args:
+            model: The configuration entry of the model.
+
+        Returns:
+            The model's tokenizer.
+        """
+        name = model.get("tokenizer", DEFAULT_TOKENIZER)
+        with self._lock:
+            tokenizer = self._tokenizers.get(name)
+            if tokenizer is None:
+                tokenizer = CLIPTokenizer.from_pretrained(name, token=self._auth_token)
+                self._tokenizers[name] = tokenizer
+            return tokenizer
+
+    def count_tokens(self, model: dict, text: str) -> int:
+        return len(self.get(model)(text)["input_ids"])
+
+def validate_job(job_data: dict, model: Optional[dict], tokenizers: TokenizerCache) -> Optional[str]:
+    """
+    Checks a job before it is queued, so invalid jobs never take a queue slot
+    or cause a model to be loaded.
+
+    Args:
+        job_data: The job's request data.
+        model: The configuration entry of the requested model, or None if the
+            model does not exist.
+        tokenizers: The tokenizer cache used to count prompt tokens.
+
+    Returns:
+        A message describing why the job is invalid, or None if it is valid.
+    """
+    if model is None:
+        return f"Model '{job_data['model']}' not found"
+    if not hasattr(diffusers, model["pipeline"]):
+        return f"Pipeline '{model['pipeline']}' not found"
+    if model["pipeline"] not in SUPPORTED_PIPELINES:
+        return f"Pipeline '{model['pipeline']}' can't generate images from text"
+    for dimension in ("width", "height"):
+        value = job_data[dimension]
+        if not MIN_DIMENSION <= value <= MAX_DIMENSION:
+            return f"The {dimension} must be between {MIN_DIMENSION} and {MAX_DIMENSION} pixels"
+        if value % DIMENSION_MULTIPLE != 0:
+            return f"The {dimension} must be a multiple of {DIMENSION_MULTIPLE}"
+    if not MIN_STEPS <= job_data["steps"] <= MAX_STEPS:
+        return f"The number of steps must be between {MIN_STEPS} and {MAX_STEPS}"
+    if job_data.get("seed") is not None and not 0 <= job_data["seed"] <= MAX_SEED:
+        return f"The seed must be between 0 and {MAX_SEED}"
+    max_images = model.get("max_images", DEFAULT_MAX_IMAGES)
+    if not MIN_IMAGES <= job_data.get("num_images", 1) <= max_images:
+        return f"The number of images must be between {MIN_IMAGES} and {max_images} for this model"
+    if job_data.get("deadline") is not None and job_data["deadline"] <= time.time():
+        return "The deadline of this job has already passed"
+    if tokenizers.count_tokens(model, job_data["prompt"]) > MAX_PROMPT_TOKENS:
+        return "Prompt is too long"
+    if tokenizers.count_tokens(model, job_data["negative_prompt"]) > MAX_PROMPT_TOKENS:
+        return "Negative Prompt is too long"
+    return None
@@ -0,0 +1,146 @@
+# ----------------------------------------------------------#
+# Licensed under the GNU Affero General Public License v3.0 #
+# ----------------------------------------------------------#
+
+import os
+import queue
+import threading
+import time
+from typing import Callable, Optional
+import psutil
+import torch
+from modules.pipeline_cache import PipelineCache
+
+class InferenceWorker:
+    def __init__(self, worker_id: int, device: str, num_threads: Optional[int], pipeline_cache: PipelineCache):
+        self.worker_id = worker_id
+        self.device = device
+        self.num_threads = num_threads
+        self.pipeline_cache = pipeline_cache
+        self.busy = False
+        self.current_batch = None
+        self.nsfw_screener = None
+        self._inbox = queue.Queue(maxsize=1)
+        self._thread = None
+        self._pending_evictions = set()
+        self._evictions_lock = threading.Lock()
+        self._idle_seconds = 0.0
+        self._idle_since = None
+        self._idle_lock = threading.Lock()
+
+    @property
+    def is_cuda(self) -> bool:
+        return self.device.startswith("cuda")
+
+    @property
+    def gpu_id(self) -> int:
+        return int(self.device.split(":")[1]) if ":" in self.device else 0
+
+    @property
+    def torch_dtype(self) -> torch.dtype:
+        # Half precision is poorly supported by CPU kernels, so CPU slots run
+        # in full precision.
+        return torch.float16 if self.is_cuda else torch.float32
+
+    @property
+    def memory_bytes(self) -> int:
+        if self.is_cuda:
+            return torch.cuda.get_device_properties(self.gpu_id).total_memory
+        return psutil.virtual_memory().total
+
+    @property
+    def idle_seconds(self) -> float:
+        """
+        The total time the worker has spent waiting for a batch since it
+        finished warming up, including the current wait.
+        """
+        with self._idle_lock:
+            if self._idle_since is None:
+                return self._idle_seconds
+            return self._idle_seconds + time.monotonic() - self._idle_since
+
+    def start(self, target: Callable, stop_event: threading.Event, on_start: Optional[Callable] = None):
+        self._thread = threading.Thread(target=self._run, args=(target, stop_event, on_start))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def assign(self, batch: list):
+        self._inbox.put(batch)
+
+    def evict_later(self, model_ids: list[str]):
+        """
+        Schedules models' pipelines to be evicted on the worker's own thread,
+        between batches, so a pipeline is never released while it is in use.
+
+        Args:
+            model_ids: The IDs of the models to evict.
+        """
+        with self._evictions_lock:
+            self._pending_evictions.update(model_ids)
+
+    def _apply_evictions(self):
+        with self._evictions_lock:
+            model_ids = list(self._pending_evictions)
+            self._pending_evictions.clear()
+        for model_id in model_ids:
+            self.pipeline_cache.evict(model_id)
+
+    def _run(self, target: Callable, stop_event: threading.Event, on_start: Optional[Callable]):
+        if self.num_threads is not None:
+            # The OpenMP thread count is per calling thread, so each CPU slot
+            # keeps its own intra-op pool size.
+            torch.set_num_threads(self.num_threads)
+        if on_start is not None:
+            on_start(self)
+        self._set_idle(True)
+        while not stop_event.is_set():
+            self._apply_evictions()
+            try:
+                batch = self._inbox.get(block=True, timeout=1)
+            except queue.Empty:
+                continue
+            self._set_idle(False)
+            target(self, batch)
+            self._set_idle(True)
+
+    def _set_idle(self, idle: bool):
+        with self._idle_lock:
+            now = time.monotonic()
+            if self._idle_since is not None:
+                self._idle_seconds += now - self._idle_since
+            self._idle_since = now if idle else None
+
+def parse_devices(devices_spec: Optional[str]) -> list[tuple[str, Optional[int]]]:
+    """
+    Parses a comma separated device list into (device, thread count) pairs.
+    CUDA devices are written as "cuda:<index>", and CPU slots as "cpu" or
+    "cpu:<threads>". When no list is given, one worker is created per visible
+    CUDA device, or a single CPU slot using every core if there are none.
+
+    Args:
+        devices_spec: The device list, for example "cuda:0,cuda:1" or
+            "cpu:4,cpu:4".
+
+    Returns:
+        A list of (device, thread count) tuples. The thread count is None for
+        CUDA devices.
+    """
+    if not devices_spec:
+        if torch.cuda.is_available():
+            return [(f"cuda:{index}", None) for index in range(torch.cuda.device_count())]
+        return [("cpu", os.cpu_count() or 1)]
+    devices = []
+    for device in devices_spec.split(","):
+        device = device.strip()
+        if device.startswith("cuda"):
+            devices.append((device if ":" in device else "cuda:0", None))
+        elif device.startswith("cpu"):
+            num_threads = int(device.split(":")[1]) if ":" in device else os.cpu_count() or 1
+            devices.append(("cpu", num_threads))
+        else:
+            raise ValueError(f"Unknown inference device '{device}'")
+    return devices
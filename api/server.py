@@ -2,15 +2,30 @@
 # Licensed under the GNU Affero General Public License v3.0 #
 # ----------------------------------------------------------#
 
-from fastapi import FastAPI
+import os
+from typing import Literal, Optional
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from modules.request_models import InferenceRequest
 from modules import general
-from modules.job_processing import DiffusionJobProcessor
+from modules.model_registry import ModelRegistry
+from modules.remote_processor import InferenceServiceUnavailable, RemoteJobProcessor
 
 APP = FastAPI()
-CONFIG = general.get_config()
+MODEL_REGISTRY = ModelRegistry()
 NEGATIVE_PROMPT = general.get_negative_prompt()
-JOB_PROCESSOR = DiffusionJobProcessor()
+# The admin endpoints are disabled unless a token is configured.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+# With INFERENCE_SOCKET set, this process is only an HTTP frontend for the
+# inference service started by inference_server.py, and can be run with any
+# number of workers. Otherwise the models are run in this process.
+INFERENCE_SOCKET = os.environ.get("INFERENCE_SOCKET")
+if INFERENCE_SOCKET:
+    JOB_PROCESSOR = RemoteJobProcessor(INFERENCE_SOCKET)
+else:
+    # pylint: disable=C0415
+    from modules.job_processing import DiffusionJobProcessor
+    JOB_PROCESSOR = DiffusionJobProcessor(model_registry=MODEL_REGISTRY)
 
 @APP.on_event("startup")
 def startup():
@@ -20,18 +35,40 @@ def startup():
 def shutdown():
     JOB_PROCESSOR.stop_processing()
 
+@APP.exception_handler(InferenceServiceUnavailable)
+def inference_service_unavailable(_request: Request, _exc: InferenceServiceUnavailable):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "The inference service is restarting, please try again shortly."},
+        headers={"Retry-After": "10"}
+    )
+
 @APP.get("/")
 def read_root():
     return {
         "text": "We're online!"
     }
 
-@APP.get("/queue_info")
-def read_queue():
+@APP.get("/health")
+def read_health():
+    if not JOB_PROCESSOR.is_ready():
+        return JSONResponse(status_code=503, content={"ready": False})
     return {
-        "Hello": "World"
+        "ready": True
     }
 
+@APP.get("/queue_info")
+def read_queue():
+    return JOB_PROCESSOR.get_queue_info()
+
+@APP.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    return PlainTextResponse(JOB_PROCESSOR.render_metrics(), media_type="text/plain; version=0.0.4")
+
+@APP.get("/cache_info")
+def read_cache():
+    return JOB_PROCESSOR.get_cache_stats()
+
 @APP.get("/get_negative_prompt")
 def get_negative_prompt():
     return {
@@ -39,27 +76,91 @@ def get_negative_prompt():
     }
 
 @APP.get("/get_models")
-def get_models():
+def get_models(request: Request):
+    etag = f"\"{MODEL_REGISTRY.etag}\""
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
     models = []
-    for model in CONFIG:
+    for model in MODEL_REGISTRY.list():
         models.append({
             "id": model["id"],
             "name": model["name"],
             "is_nsfw": model["is_nsfw"]
         })
-    return {
-        "models": models
-    }
+    return JSONResponse(content={"models": models}, headers={"ETag": etag})
+
+@APP.post("/admin/reload_models")
+def reload_models(authorization: Optional[str] = Header(None)):
+    if ADMIN_TOKEN is None or authorization != f"Bearer {ADMIN_TOKEN}":
+        raise HTTPException(status_code=403, detail="A valid admin token is required.")
+    try:
+        result = JOB_PROCESSOR.reload_models()
+        if INFERENCE_SOCKET:
+            # Frontends keep a registry of their own for /get_models.
+            MODEL_REGISTRY.reload()
+        return result
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=500, detail=f"Could not reload config.json: {e}") from e
 
 @APP.post("/inference")
 def inference(inference_req: InferenceRequest):
-    job_id = JOB_PROCESSOR.add_job(inference_req.dict())
+    job_data = inference_req.dict()
+    error = JOB_PROCESSOR.validate_job(job_data)
+    if error is not None:
+        raise HTTPException(status_code=400, detail=error)
+    retry_after = JOB_PROCESSOR.get_retry_after(job_data)
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=429,
+            detail=f"The server is busy, try again in {retry_after} seconds.",
+            headers={"Retry-After": str(retry_after)}
+        )
+    job_id = JOB_PROCESSOR.add_job(job_data)
+    result = JOB_PROCESSOR.get_result(job_id, include_image=False)
     return {
         "success": True,
-        "job_id": job_id
+        "job_id": job_id,
+        "position": result.get("position"),
+        "eta_seconds": result.get("eta_seconds")
+    }
+
+@APP.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    cancelled = JOB_PROCESSOR.cancel_job(job_id)
+    if cancelled is None:
+        raise HTTPException(status_code=404, detail="No job exists with this ID.")
+    if not cancelled:
+        raise HTTPException(status_code=409, detail="This job has already finished.")
+    return {
+        "success": True
     }
 
 @APP.get("/get_result/{job_id}")
-def get_result(job_id: str):
-    result = JOB_PROCESSOR.get_result(job_id)
+def get_result(job_id: str, include_image: bool = True):
+    result = JOB_PROCESSOR.get_result(job_id, include_image)
     return result
+
+@APP.get("/stream_result/{job_id}")
+async def stream_result(job_id: str):
+    # The stream is opened before the response starts, while an unreachable
+    # inference service can still be answered with a 503.
+    events = await JOB_PROCESSOR.open_result_stream(job_id)
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+@APP.get("/get_image/{job_id}")
+def get_image(
+        job_id: str,
+        image_format: Literal["png", "webp", "jpeg"] = Query("png", alias="format"),
+        quality: int = Query(90, ge=1, le=100),
+        lossless: bool = False,
+        index: int = Query(0, ge=0)
+):
+    image = JOB_PROCESSOR.get_image(job_id, image_format, quality, lossless, index)
+    if image is None:
+        raise HTTPException(status_code=404, detail="No image is available for this job.")
+    data, mime_type = image
+    return Response(content=data, media_type=mime_type)
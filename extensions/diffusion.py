@@ -4,8 +4,12 @@
 
 # pylint: disable=E1101, R1702, R0911
 
-import os
 import asyncio
+import io
+import os
+import json
+import time
+from typing import AsyncIterator
 import aiohttp
 import discord
 from discord.ext import commands
@@ -14,6 +18,42 @@ from modules import configuration, logging_utils, database_utils, general_utils
 CORE_CONF = configuration.CoreConfiguration()
 DIFFUSION_CONF = configuration.DiffusionConfiguration()
 LOGGER = logging_utils.Logger()
+# Discord rate limits message edits, so progress is shown at most this often.
+PROGRESS_EDIT_INTERVAL = 2.0
+STREAM_RECONNECT_ATTEMPTS = 10
+STREAM_RECONNECT_DELAY = 6.0
+# Interaction tokens expire after 15 minutes, after which the response can no
+# longer be edited, so there is no point in the backend finishing the image.
+INTERACTION_LIFETIME = 15 * 60
+
+async def read_job_events(response: aiohttp.ClientResponse) -> AsyncIterator[dict]:
+    """Parses the Server-Sent Events sent by the API's /stream_result endpoint."""
+    async for line in response.content:
+        line = line.decode("UTF-8").strip()
+        if line.startswith("data:"):
+            yield json.loads(line[len("data:"):])
+
+def build_pending_embed(data: dict) -> discord.Embed:
+    description = "Your image is currently in the queue to be generated. Please wait a few moments."
+    if data.get("position") is not None:
+        description += f"\n\n**Position in queue:** `{data['position']}`"
+    if data.get("eta_seconds") is not None:
+        description += f"\n**Estimated wait:** `{round(data['eta_seconds'])}s`"
+    return discord.Embed(
+        title=":clock1: Pending",
+        description=description
+    )
+
+def build_processing_embed(data: dict) -> discord.Embed:
+    description = "Your image is currently being generated. Please wait a few moments."
+    progress = data.get("progress")
+    if progress is not None:
+        filled = round(10 * progress["step"] / progress["total_steps"])
+        description += f"\n\n`{'█' * filled}{'░' * (10 - filled)}` {progress['step']}/{progress['total_steps']}"
+    return discord.Embed(
+        title=":clock1: Processing",
+        description=description
+    )
 
 class DiffusionCommands(commands.Cog):
     def __init__(self, bot: discord.Bot):
@@ -64,6 +104,19 @@ class DiffusionCommands(commands.Cog):
         description="Optionally, provide a negative prompt, which is what you would like to avoid in your image.",
         default=""
     )
+    @discord.option(
+        "speed",
+        description="Trade image quality for generation speed.",
+        choices=["Fast", "Balanced", "Quality"],
+        default="Balanced"
+    )
+    @discord.option(
+        "images",
+        description="How many variations of your prompt to generate. Maximum 4.",
+        min_value=1,
+        max_value=4,
+        default=1
+    )
     async def generateimage(
             self,
             ctx: discord.ApplicationContext,
@@ -74,7 +127,9 @@ class DiffusionCommands(commands.Cog):
             private: bool,
             cfgscale: str,
             steps: int,
-            negative: str
+            negative: str,
+            speed: str,
+            images: int
     ):
         if not database_utils.is_allowed_diffusion(ctx.guild.id, ctx.author):
             invalid_permissions_embed = discord.Embed(
@@ -117,9 +172,30 @@ class DiffusionCommands(commands.Cog):
                     "width": width,
                     "height": height,
                     "steps": steps,
-                    "cfg_scale": cfgscale
+                    "cfg_scale": cfgscale,
+                    "speed_tier": speed.lower(),
+                    "num_images": images,
+                    "user_id": ctx.author.id,
+                    "guild_id": ctx.guild.id,
+                    "deadline": ctx.interaction.created_at.timestamp() + INTERACTION_LIFETIME
                 }
             ) as response:
+                if response.status == 400:
+                    data = await response.json()
+                    invalid_request_embed = discord.Embed(
+                        title=":warning: Invalid Request",
+                        description=data["detail"]
+                    )
+                    await ctx.respond(embed=invalid_request_embed, ephemeral=True)
+                    return
+                if response.status == 429:
+                    retry_after = response.headers.get("Retry-After", "a few")
+                    busy_embed = discord.Embed(
+                        title=":hourglass: Busy",
+                        description=f"The image generator is busy right now, try again in {retry_after} seconds."
+                    )
+                    await ctx.respond(embed=busy_embed, ephemeral=True)
+                    return
                 if not response.ok:
                     invalid_backend_response_embed = discord.Embed(
                         title=":warning: Could not reach the backend!",
@@ -130,11 +206,8 @@ class DiffusionCommands(commands.Cog):
                 data = await response.json()
                 if data["success"]:
                     job_id = data["job_id"]
-                    job_id_embed = discord.Embed(
-                        title=":clock1: Pending",
-                        description="Your image is currently in the queue to be generated. Please wait a few moments."
-                    )
-                    await ctx.respond(embed=job_id_embed, ephemeral=private)
+                    last_position = data.get("position")
+                    await ctx.respond(embed=build_pending_embed(data), ephemeral=private)
                 else:
                     invalid_backend_response_embed = discord.Embed(
                         title=":warning: Invalid Response from Backend!",
@@ -142,47 +215,111 @@ class DiffusionCommands(commands.Cog):
                     )
                     await ctx.respond(embed=invalid_backend_response_embed)
                     return
-            completed = False
             last_status = "PENDING"
-            while not completed:
-                async with session.get(
-                    self.api_url + f"/get_result/{job_id}"
-                ) as response:
-                    if not response.ok:
-                        invalid_backend_response_embed = discord.Embed(
-                            title=":warning: Could not reach the backend!",
-                            description="The bot had a problem reaching the backend. Please try again later."
-                        )
-                        await ctx.respond(embed=invalid_backend_response_embed)
-                        return
-                    data = await response.json()
-                    if data["status"] == "PROCESSING" and last_status != "PROCESSING":
-                        processing_embed = discord.Embed(
-                            title=":clock1: Processing",
-                            description="Your image is currently being generated. Please wait a few moments."
-                        )
-                        await ctx.edit(embed=processing_embed)
-                    elif data["status"] == "COMPLETED":
-                        completed = True
-                        converted_image = general_utils.conver_data_url_to_bytes(data["image"])
-                        elapsed_time = data["elapsed_time"]
-                        image_embed = discord.Embed(
-                            title=":white_check_mark: Completed!",
-                            description="Your image has been successfully generated."
-                        )
-                        image_embed.set_image(url="attachment://image.png")
-                        image_embed.set_footer(text=f"Time taken: {elapsed_time}")
-                        await ctx.edit(embed=image_embed, file=discord.File(converted_image, "image.png", spoiler=private))
-                        return
-                    elif data["status"] == "FAILED":
-                        failed_embed = discord.Embed(
-                            title=":warning: Failed to Generate Image",
-                            description=data["error"]
-                        )
-                        await ctx.edit(embed=failed_embed)
-                        return
-                    last_status = data["status"]
-                    await asyncio.sleep(2)
+            last_progress_edit = 0.0
+            last_preview = None
+            # A restarting backend drops the stream but picks the job back up
+            # from its journal, so reconnect for a while before giving up.
+            for attempt in range(STREAM_RECONNECT_ATTEMPTS + 1):
+                if attempt > 0:
+                    await asyncio.sleep(STREAM_RECONNECT_DELAY)
+                try:
+                    async with session.get(
+                        self.api_url + f"/stream_result/{job_id}",
+                        timeout=aiohttp.ClientTimeout(total=None, sock_read=60)
+                    ) as response:
+                        if not response.ok:
+                            continue
+                        async for data in read_job_events(response):
+                            if "status" not in data:
+                                break
+                            if data.get("status") == "PENDING" and data.get("position") != last_position:
+                                last_position = data.get("position")
+                                await ctx.edit(embed=build_pending_embed(data))
+                            elif data.get("status") == "PROCESSING" and (
+                                    last_status != "PROCESSING"
+                                    or time.monotonic() - last_progress_edit >= PROGRESS_EDIT_INTERVAL
+                            ):
+                                last_progress_edit = time.monotonic()
+                                processing_embed = build_processing_embed(data)
+                                if "preview" in data:
+                                    processing_embed.set_image(url="attachment://preview.webp")
+                                # The preview stays in the job's record until the next one, so
+                                # it is only uploaded again once it has changed.
+                                if "preview" in data and data["preview"] != last_preview:
+                                    last_preview = data["preview"]
+                                    preview = general_utils.conver_data_url_to_bytes(data["preview"])
+                                    await ctx.edit(
+                                        embed=processing_embed,
+                                        file=discord.File(preview, "preview.webp", spoiler=private),
+                                        attachments=[]
+                                    )
+                                else:
+                                    await ctx.edit(embed=processing_embed)
+                            elif data.get("status") == "COMPLETED":
+                                elapsed_time = data["elapsed_time"]
+                                num_images = data.get("num_images", 1)
+                                verdicts = data.get("nsfw", [None] * num_images)
+                                image_files = []
+                                for index in range(num_images):
+                                    async with session.get(
+                                        self.api_url + f"/get_image/{job_id}",
+                                        params={"format": "webp", "lossless": "true", "index": index}
+                                    ) as image_response:
+                                        if not image_response.ok:
+                                            invalid_backend_response_embed = discord.Embed(
+                                                title=":warning: Could not reach the backend!",
+                                                description=(
+                                                    "The bot had a problem reaching the backend. "
+                                                    "Please try again later."
+                                                )
+                                            )
+                                            await ctx.edit(embed=invalid_backend_response_embed)
+                                            return
+                                        image_bytes = await image_response.read()
+                                    flagged = verdicts[index] is not None and verdicts[index]["flagged"]
+                                    image_files.append(discord.File(
+                                        io.BytesIO(image_bytes),
+                                        f"image-{index}.webp",
+                                        spoiler=private or flagged
+                                    ))
+                                image_embed = discord.Embed(
+                                    title=":white_check_mark: Completed!",
+                                    description=(
+                                        "Your image has been successfully generated." if num_images == 1
+                                        else f"Your {num_images} images have been successfully generated."
+                                    )
+                                )
+                                # Several attachments are shown as a gallery
+                                # below the embed instead of inside it.
+                                if num_images == 1:
+                                    image_embed.set_image(url="attachment://image-0.webp")
+                                image_embed.set_footer(text=f"Time taken: {elapsed_time}")
+                                await ctx.edit(
+                                    embed=image_embed,
+                                    files=image_files,
+                                    attachments=[]
+                                )
+                                return
+                            elif data.get("status") == "FAILED":
+                                failed_embed = discord.Embed(
+                                    title=":warning: Failed to Generate Image",
+                                    description=data["error"]
+                                )
+                                await ctx.edit(embed=failed_embed)
+                                return
+                            last_status = data.get("status")
+                        else:
+                            # The stream ended without a final status.
+                            continue
+                    break
+                except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                    continue
+            lost_job_embed = discord.Embed(
+                title=":warning: Invalid Response from Backend!",
+                description="The backend stopped reporting on your image. Please try again later."
+            )
+            await ctx.edit(embed=lost_job_embed)
 
 
 
@@ -13,17 +13,9 @@ from modules.configuration import DiffusionOption
 CORE_CONF = configuration.CoreConfiguration()
 LOGGER = logging_utils.Logger()
 
-DISALLOWED_LABELS = [
-    "BUTTOCKS_EXPOSED",
-    "FEMALE_BREAST_EXPOSED",
-    "FEMALE_GENITALIA_EXPOSED",
-    "MALE_BREAST_EXPOSED",
-    "ANUS_EXPOSED",
-    "FEET_EXPOSED",
-    "FACE_MALE",
-    "BELLY_EXPOSED",
-    "MALE_GENITALIA_EXPOSED"
-]
+# Shared with the API, which screens generated images with the same labels.
+with open(os.path.join(os.getcwd(), "api", "nsfw_labels.txt"), encoding="UTF-8") as f:
+    DISALLOWED_LABELS = [line.strip() for line in f if line.strip()]
 
 async def predict_nsfw(img_bytes: bytes) -> bool:
     detector = NudeDetector(model_path="./assets/640m.onnx")